@@ -28,6 +28,7 @@ setup(
         "snowflake-connector-python[secure-local-storage,pandas]>=3.0.0",
         "xlsxwriter",
         "questionary",
+        "ijson",
     ],
     extras_require={
         "all": [],
@@ -0,0 +1,99 @@
+"""Benchmark of the key alignment in vdc.diff._compare_df.
+
+Compares the current outer join implementation with the previous one, which
+reindexed both frames with Python lists of the keys and called
+DataFrame.compare. Run from the repository root:
+
+    python tests/benchmark/bench_compare_df.py
+    python tests/benchmark/bench_compare_df.py --keys 1000000
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from vdc.diff import _compare_df
+
+
+def _compare_df_reindex(prod_df, dev_df, prod_name, dev_name, primary_key):
+    prod_df = prod_df.set_index(primary_key)
+    dev_df = dev_df.set_index(primary_key)
+
+    prod_diff = prod_df.index.difference(dev_df.index)
+    dev_diff = dev_df.index.difference(prod_df.index)
+
+    df1 = prod_df.reindex(
+        prod_df.index.values.tolist() + dev_diff.values.tolist()
+    ).sort_index()
+    df2 = dev_df.reindex(
+        dev_df.index.values.tolist() + prod_diff.values.tolist()
+    ).sort_index()
+
+    return df1.compare(other=df2, align_axis=0, result_names=(prod_name, dev_name))
+
+
+def _frames(keys: int, seed: int = 0) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Two shuffled frames with 1% changed values and 0.1% missing keys per side"""
+    rng = np.random.default_rng(seed)
+    ids = np.arange(keys)
+    prod_df = pd.DataFrame(
+        {
+            "ID": ids,
+            "AMOUNT": rng.integers(0, 1000, keys).astype("float64"),
+            "CODE": rng.integers(0, 100, keys),
+        }
+    )
+    dev_df = prod_df.copy()
+    changed = rng.choice(keys, keys // 100, replace=False)
+    dev_df.loc[changed, "AMOUNT"] += 1
+    missing = keys // 1000
+    prod_df = prod_df.iloc[missing:].sample(frac=1, random_state=seed)
+    dev_df = dev_df.iloc[:-missing].sample(frac=1, random_state=seed + 1)
+    return prod_df, dev_df
+
+
+def _measure(compare, prod_df, dev_df) -> tuple[float, float, int]:
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = compare(prod_df, dev_df, "prod", "dev", "ID")
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / 1024**2, len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--keys", type=int, nargs="+", default=[1_000_000, 10_000_000])
+    args = parser.parse_args()
+
+    print(
+        "keys".rjust(12)
+        + "implementation".rjust(16)
+        + "seconds".rjust(10)
+        + "peak MiB".rjust(12)
+        + "diff rows".rjust(12)
+    )
+    for keys in args.keys:
+        prod_df, dev_df = _frames(keys)
+        for name, compare in (
+            ("reindex", _compare_df_reindex),
+            ("outer join", _compare_df),
+        ):
+            seconds, peak, rows = _measure(compare, prod_df, dev_df)
+            print(
+                f"{keys}".rjust(12)
+                + name.rjust(16)
+                + f"{seconds:.2f}".rjust(10)
+                + f"{peak:.0f}".rjust(12)
+                + f"{rows}".rjust(12)
+            )
+
+
+if __name__ == "__main__":
+    main()
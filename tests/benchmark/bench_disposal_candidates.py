@@ -0,0 +1,120 @@
+"""Benchmark of the candidate matching in vdc waste disposal.
+
+Compares vdc.waste._find_candidate_tables with the previous row by row loop,
+which also built a throwaway questionary Choice per candidate, on a synthetic
+inventory where 10% of the tables are not in dbt. Run from the repository root:
+
+    python tests/benchmark/bench_disposal_candidates.py
+    python tests/benchmark/bench_disposal_candidates.py --tables 100000
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from questionary import Choice
+
+from vdc.waste import _find_candidate_tables
+
+
+def _find_candidate_tables_loop(tables, dbt_tables, ignore_tables=()):
+    dbt_tables_not_transient = set(
+        table.removesuffix("__transient") for table in dbt_tables
+    )
+    candidates = []
+    for table in tables:
+        if table["TABLE_SCHEMA"] == "PUBLIC":
+            continue
+        if table["TABLE_SCHEMA"] == "INFORMATION_SCHEMA":
+            continue
+        db_table = f"{table['TABLE_CATALOG']}.{table['TABLE_SCHEMA']}.{table['TABLE_NAME']}".lower()
+        if ignore_tables and db_table in ignore_tables:
+            continue
+        if db_table in dbt_tables:
+            continue
+        if db_table in dbt_tables_not_transient:
+            continue
+        if "drp" in db_table:
+            continue
+        Choice(
+            title=f"{db_table}".ljust(110) + f"Last altered: {table['LAST_ALTERED']}",
+            value=db_table,
+        )
+        candidates.append({"name": db_table, "last_altered": table["LAST_ALTERED"]})
+    candidates.sort(key=lambda x: x["name"])
+    return candidates
+
+
+def _inventory(tables: int) -> tuple[list[dict], set[str], list[str]]:
+    """Tables in 30 databases and 20 schemas each, with every tenth table
+    missing from dbt, every hundredth marked for removal and every 50th
+    transient in dbt"""
+    rows = []
+    dbt_tables = set()
+    for i in range(tables):
+        catalog, schema, name = f"DB_{i % 30}", f"SCHEMA_{i % 20}", f"TABLE_{i}"
+        if i % 100 == 1:
+            name += "_BCK_20240101_USER_X_DRP_202402"
+        rows.append(
+            {
+                "TABLE_CATALOG": catalog,
+                "TABLE_SCHEMA": schema,
+                "TABLE_NAME": name,
+                "LAST_ALTERED": "2024-01-01 00:00:00",
+            }
+        )
+        if i % 10:
+            relation = f"{catalog}.{schema}.{name}".lower()
+            dbt_tables.add(relation + "__transient" if i % 50 == 2 else relation)
+    ignore_tables = [
+        f"db_{i % 30}.schema_{i % 20}.table_{i}" for i in range(0, 1000, 10)
+    ]
+    return rows, dbt_tables, ignore_tables
+
+
+def _measure(find, rows, dbt_tables, ignore_tables) -> tuple[float, float, int]:
+    gc.collect()
+    start = time.perf_counter()
+    result = find(rows, dbt_tables, ignore_tables)
+    seconds = time.perf_counter() - start
+    # Measured in a second run, as tracing slows down the first
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = find(rows, dbt_tables, ignore_tables)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / 1024**2, len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tables", type=int, nargs="+", default=[500_000])
+    args = parser.parse_args()
+
+    print(
+        "tables".rjust(12)
+        + "implementation".rjust(16)
+        + "seconds".rjust(10)
+        + "peak MiB".rjust(12)
+        + "candidates".rjust(12)
+    )
+    for tables in args.tables:
+        rows, dbt_tables, ignore_tables = _inventory(tables)
+        for name, find in (
+            ("loop", _find_candidate_tables_loop),
+            ("set index", _find_candidate_tables),
+        ):
+            seconds, peak, candidates = _measure(find, rows, dbt_tables, ignore_tables)
+            print(
+                f"{tables}".rjust(12)
+                + name.rjust(16)
+                + f"{seconds:.2f}".rjust(10)
+                + f"{peak:.0f}".rjust(12)
+                + f"{candidates}".rjust(12)
+            )
+
+
+if __name__ == "__main__":
+    main()
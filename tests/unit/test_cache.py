@@ -0,0 +1,41 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from vdc.cache import ACCOUNT_SCOPE, MetadataCache
+
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / "metadata.sqlite"
+
+    def test_get_and_set(self):
+        cache = MetadataCache(self.path)
+        self.assertIsNone(cache.get("desc table db.s.t"))
+        cache.set("desc table db.s.t", [{"name": "ID"}], scope="DB")
+        self.assertEqual(cache.get("desc table db.s.t"), [{"name": "ID"}])
+
+    def test_ttl(self):
+        cache = MetadataCache(self.path, ttl=60)
+        cache.set("key", [], scope="db")
+        with mock.patch("vdc.cache.time.time", return_value=time.time() + 61):
+            self.assertIsNone(cache.get("key"))
+
+    def test_disabled(self):
+        cache = MetadataCache(self.path, ttl=0)
+        cache.set("key", [], scope="db")
+        self.assertIsNone(cache.get("key"))
+
+    def test_invalidate(self):
+        cache = MetadataCache(self.path)
+        cache.set("db", [1], scope="db")
+        cache.set("other", [2], scope="other")
+        cache.set("account", [3], scope=ACCOUNT_SCOPE)
+        cache.invalidate(["DB"])
+        self.assertIsNone(cache.get("db"))
+        self.assertIsNone(cache.get("account"))
+        self.assertEqual(cache.get("other"), [2])
@@ -0,0 +1,227 @@
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+from snowflake.connector.constants import QueryStatus
+from snowflake.connector.errors import ProgrammingError
+
+from vdc.clone import (
+    _clone_order,
+    _clone_pairs,
+    _grant_usage,
+    _partial_clone_plan,
+    _run_concurrently,
+    _suspend_dynamic_tables,
+    plan_clone,
+)
+
+
+class FakeConnection:
+    """Runs every query for two polls, and fails queries containing 'bad'"""
+
+    def __init__(self):
+        self.statements = {}
+        self.polls = {}
+        self.max_running = 0
+        self.cur = mock.MagicMock()
+        self.cur.execute_async.side_effect = self._execute_async
+
+    def cursor(self):
+        return self.cur
+
+    def _execute_async(self, statement):
+        self.cur.sfqid = str(len(self.statements))
+        self.statements[self.cur.sfqid] = statement
+        self.polls[self.cur.sfqid] = 0
+        self.max_running = max(self.max_running, len(self.polls))
+
+    def get_query_status_throw_if_error(self, query_id):
+        self.polls[query_id] += 1
+        if self.polls[query_id] < 2:
+            return QueryStatus.RUNNING
+        del self.polls[query_id]
+        if "bad" in self.statements[query_id]:
+            raise ProgrammingError(msg="failed")
+        return QueryStatus.SUCCESS
+
+    @staticmethod
+    def is_still_running(status):
+        return status == QueryStatus.RUNNING
+
+
+def _row(side, kind, schema, table=None, **kwargs):
+    return {
+        "SIDE": side,
+        "KIND": kind,
+        "TABLE_SCHEMA": schema,
+        "TABLE_NAME": table,
+        "TABLE_TYPE": kwargs.get("table_type", "BASE TABLE"),
+        "IS_TRANSIENT": kwargs.get("transient", "NO"),
+        "IS_DYNAMIC": kwargs.get("dynamic", "NO"),
+        "LAST_ALTERED": kwargs.get("last_altered", 1),
+        "CREATED": kwargs.get("created", 1),
+    }
+
+
+class TestClone(unittest.TestCase):
+    def test_suspend_dynamic_tables(self):
+        dynamic_tables = [
+            {"schema_name": "S", "name": "A", "scheduling_state": "ACTIVE"},
+            {"schema_name": "S", "name": "B", "scheduling_state": "SUSPENDED"},
+        ]
+        self.assertEqual(
+            _suspend_dynamic_tables(db="dev", dynamic_tables=dynamic_tables),
+            ["alter dynamic table dev.S.A suspend"],
+        )
+
+    @mock.patch("vdc.clone.time.sleep")
+    def test_run_concurrently(self, sleep):
+        ctx = FakeConnection()
+        statements = [f"stmt {i}" for i in range(5)] + _grant_usage("dev", ["bad"])
+        results = _run_concurrently(ctx, statements, max_concurrency=2)
+        self.assertEqual([r["statement"] for r in results], statements)
+        self.assertEqual(ctx.max_running, 2)
+        self.assertEqual([r["error"] is None for r in results], [True] * 5 + [False])
+        self.assertTrue(all(r["seconds"] is not None for r in results))
+
+    def test_clone_pairs(self):
+        self.assertEqual(_clone_pairs(("prod", "dev")), [("prod", "dev")])
+        self.assertEqual(
+            _clone_pairs(("raw:dev_raw", "marts:dev_marts")),
+            [("raw", "dev_raw"), ("marts", "dev_marts")],
+        )
+        with self.assertRaises(ValueError):
+            _clone_pairs(("raw:dev_raw", "marts"))
+
+    def test_clone_order(self):
+        self.assertEqual(
+            _clone_order([("dev_raw", "test_raw"), ("raw", "DEV_RAW"), ("a", "b")]),
+            [("raw", "DEV_RAW"), ("a", "b"), ("dev_raw", "test_raw")],
+        )
+        with self.assertRaises(ValueError):
+            _clone_order([("a", "b"), ("c", "b")])
+        with self.assertRaises(ValueError):
+            _clone_order([("a", "b"), ("b", "a")])
+
+    def test_partial_clone_plan(self):
+        rows = [
+            _row("source", "schema", "A", transient="YES"),
+            _row("source", "table", "A", "DT", dynamic="YES"),
+            _row("source", "table", "A", "V", table_type="VIEW"),
+            _row("source", "schema", "B"),
+            _row("source", "table", "B", "T"),
+        ]
+        creates, clones, suspends, views = _partial_clone_plan(
+            "p",
+            "d",
+            rows + [_row("target", "schema", "B")],
+            schemas=("a",),
+            tables=("b.t",),
+        )
+        self.assertEqual(creates, [])
+        self.assertEqual(
+            clones,
+            [
+                "create or replace transient schema d.a clone p.a",
+                "create or replace table d.b.t clone p.b.t",
+            ],
+        )
+        self.assertEqual(suspends, ["alter dynamic table d.a.dt suspend"])
+        self.assertEqual(views, [])
+        with self.assertRaises(ValueError):
+            _partial_clone_plan("p", "d", rows, tables=("b.missing",))
+
+    def test_partial_clone_plan_refresh_stale(self):
+        rows = [
+            _row("source", "schema", "A"),
+            _row("source", "table", "A", "FRESH", last_altered=1),
+            _row("source", "table", "A", "STALE", last_altered=3),
+            _row("source", "table", "A", "NEW"),
+            _row("source", "table", "A", "V", table_type="VIEW"),
+            _row("source", "schema", "B"),
+            _row("source", "table", "B", "T"),
+            _row("target", "schema", "A"),
+            _row("target", "table", "A", "FRESH", created=2),
+            _row("target", "table", "A", "STALE", created=2),
+        ]
+        creates, clones, suspends, views = _partial_clone_plan(
+            "p", "d", rows, refresh_stale=True
+        )
+        self.assertEqual(creates, [])
+        self.assertEqual(
+            clones,
+            [
+                "create or replace schema d.b clone p.b",
+                "create or replace table d.a.new clone p.a.new",
+                "create or replace table d.a.stale clone p.a.stale",
+            ],
+        )
+        self.assertEqual(views, ["p.a.v"])
+
+    def test_partial_clone_plan_creates_missing_schemas(self):
+        rows = [
+            _row("source", "schema", "A", transient="YES"),
+            _row("source", "table", "A", "T"),
+            _row("source", "table", "A", "U"),
+        ]
+        creates, clones, _, _ = _partial_clone_plan(
+            "p", "d", rows, tables=("a.t", "a.u")
+        )
+        self.assertEqual(creates, ["create transient schema if not exists d.a"])
+        self.assertEqual(
+            clones,
+            [
+                "create or replace table d.a.t clone p.a.t",
+                "create or replace table d.a.u clone p.a.u",
+            ],
+        )
+
+    @mock.patch("vdc.clone.session.get_connection")
+    @mock.patch("vdc.clone._batched_metadata")
+    def test_plan_clone(self, batched_metadata, get_connection):
+        batched_metadata.return_value = [
+            [{"options": "TRANSIENT"}],
+            [{"SCHEMAS": 2, "TABLES": 10, "VIEWS": 3, "DYNAMIC_TABLES": 1}],
+            [
+                {
+                    "schema_name": "S",
+                    "name": "DT",
+                    "scheduling_state": "ACTIVE",
+                    "target_lag": "1 hour",
+                    "warehouse": "WH",
+                }
+            ],
+        ]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertTrue(plan_clone("prod", "dev", usage=("reader",)))
+        self.assertEqual(len(batched_metadata.call_args.kwargs["queries"]), 3)
+        plan = output.getvalue()
+        self.assertIn("create or replace transient database dev clone prod", plan)
+        self.assertIn("alter dynamic table dev.S.DT suspend  (async)", plan)
+        self.assertIn("target lag 1 hour, warehouse WH", plan)
+        self.assertIn("6 statements in about 8 round trips", plan)
+
+    @mock.patch("vdc.clone.session.get_connection")
+    @mock.patch("vdc.clone._batched_metadata")
+    def test_plan_clone_schema_into_missing_database(
+        self, batched_metadata, get_connection
+    ):
+        batched_metadata.return_value = [
+            [{"options": ""}],
+            [{"SCHEMAS": 1, "TABLES": 1, "VIEWS": 0, "DYNAMIC_TABLES": 0}],
+            [],
+            [],
+            [_row("source", "schema", "S"), _row("source", "table", "S", "A")],
+        ]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertTrue(plan_clone("prod", "new", schemas=("s",)))
+        # Nothing is queried in the missing database
+        batched_metadata.assert_called_once()
+        self.assertNotIn(
+            "new.information_schema",
+            "\n".join(batched_metadata.call_args.kwargs["queries"]),
+        )
+        self.assertIn("create or replace schema new.s clone prod.s", output.getvalue())
@@ -1,9 +1,28 @@
 import os
+import tempfile
 import unittest
+from pathlib import Path
+from unittest import mock
 
 import pandas as pd
+import pyarrow as pa
 
-from vdc.diff import _compare_df, _query_builder
+from vdc.diff import (
+    _bucket_predicate,
+    _compare_df,
+    _compare_partitions,
+    _diff_counts,
+    _fingerprint_query_builder,
+    _join_diff_query_builder,
+    _locate_diff_buckets,
+    _mismatched_buckets,
+    _query_builder,
+    _read_tables_file,
+    _sample_predicate,
+    _spill_batches,
+    _summary_df,
+    _summary_query_builder,
+)
 
 
 class TestTableDiff(unittest.TestCase):
@@ -63,6 +82,428 @@ class TestTableDiff(unittest.TestCase):
         result = _compare_df(prod_df, dev_df, "prod", "dev", "a")
         self.assertTrue(result.empty)
 
+    def test_join_diff_query_builder(self):
+        table_desc = [{"name": "ID"}, {"name": "B"}, {"name": "C"}]
+        compare_to_desc = [{"name": "ID"}, {"name": "B"}]
+
+        query = _join_diff_query_builder(
+            table="prod.s.t",
+            compare_to="dev.s.t",
+            columns=None,
+            ignore_columns=None,
+            primary_key="ID",
+            table_desc=table_desc,
+            compare_to_desc=compare_to_desc,
+        )
+
+        self.assertIn(
+            "from prod.s.t a\nfull outer join dev.s.t b on a.id = b.id", query
+        )
+        self.assertIn("equal_null(a.b::varchar, b.b::varchar)", query)
+        self.assertIn("equal_null(a.id::varchar, b.id::varchar)", query)
+        self.assertNotIn("a.c", query)
+
+    def test_fingerprint_query_builder(self):
+        desc = [{"name": "ID"}, {"name": "B"}]
+
+        query = _fingerprint_query_builder(
+            table="prod.s.t",
+            compare_to="dev.s.t",
+            columns=None,
+            ignore_columns=("b",),
+            primary_key="ID",
+            table_desc=desc,
+            compare_to_desc=desc,
+        )
+
+        self.assertIn("hash_agg(id) as fingerprint\nfrom prod.s.t", query)
+        self.assertIn("hash_agg(id) as fingerprint\nfrom dev.s.t", query)
+        self.assertNotIn("::varchar", query)
+
+    def test_mismatched_buckets(self):
+        rows = [
+            {"SIDE": "table", "BUCKET": 0, "ROW_COUNT": 2, "FINGERPRINT": 1},
+            {"SIDE": "compare_to", "BUCKET": 0, "ROW_COUNT": 2, "FINGERPRINT": 1},
+            {"SIDE": "table", "BUCKET": 1, "ROW_COUNT": 2, "FINGERPRINT": 1},
+            {"SIDE": "compare_to", "BUCKET": 1, "ROW_COUNT": 2, "FINGERPRINT": 2},
+            {"SIDE": "table", "BUCKET": 2, "ROW_COUNT": 3, "FINGERPRINT": 1},
+        ]
+
+        result = _mismatched_buckets(rows)
+
+        self.assertEqual(result, {1: (2, 2), 2: (3, 0)})
+
+    def _locate(self, levels, **kwargs):
+        """Locate with _fetch_buckets returning levels, one list of
+        (bucket, table rows, compare_to rows) per level"""
+        fetched = [
+            [
+                row
+                for bucket, table_rows, compare_to_rows in level
+                for row in (
+                    _bucket_row(bucket, "table", table_rows, 1),
+                    _bucket_row(bucket, "compare_to", compare_to_rows, 2),
+                )
+            ]
+            for level in levels
+        ]
+        desc = [{"name": "ID", "type": "NUMBER(38,0)"}, {"name": "A", "type": "TEXT"}]
+        with mock.patch(
+            "vdc.diff._fetch_buckets", side_effect=fetched
+        ) as fetch_buckets, mock.patch(
+            "vdc.diff._bucket_query_builder", return_value="query"
+        ) as bucket_query_builder:
+            located = _locate_diff_buckets(
+                ctx=None,
+                table="db.s.a",
+                primary_key=["ID"],
+                compare_to="dev_db.s.a",
+                columns=None,
+                ignore_columns=None,
+                table_desc=desc,
+                compare_to_desc=desc,
+                **kwargs,
+            )
+        self.assertEqual(fetch_buckets.call_count, len(levels))
+        queried = [
+            (call.kwargs["modulus"], call.kwargs["where"])
+            for call in bucket_query_builder.call_args_list
+        ]
+        return located, queried
+
+    def test_locate_diff_buckets_narrows_large_buckets(self):
+        located, queried = self._locate(
+            [
+                [(1, 100, 100), (2, 5, 6)],
+                [(5, 8, 8), (9, 50, 50)],
+                [(9, 30, 30)],
+            ],
+            buckets=4,
+            bucket_rows=10,
+            where="x > 0",
+            max_depth=3,
+        )
+
+        self.assertEqual(
+            located,
+            # Bucket 9 is still too large at max_depth and is located anyway
+            {4: {2: (5, 6)}, 16: {5: (8, 8)}, 64: {9: (30, 30)}},
+        )
+        self.assertEqual(
+            queried,
+            [
+                (4, "x > 0"),
+                (16, "(x > 0) and (mod(abs(hash(id::varchar)), 4) in (1))"),
+                (64, "(x > 0) and (mod(abs(hash(id::varchar)), 16) in (9))"),
+            ],
+        )
+
+    def test_locate_diff_buckets_stops_when_buckets_are_small(self):
+        located, queried = self._locate(
+            [[(0, 3, 4), (3, 10, 9)]], buckets=4, bucket_rows=10
+        )
+
+        self.assertEqual(located, {4: {0: (3, 4), 3: (10, 9)}})
+        self.assertEqual(queried, [(4, None)])
+
+    def test_bucket_predicate(self):
+        result = _bucket_predicate({16: [3, 1], 256: [18]}, "ID")
+
+        self.assertEqual(
+            result,
+            "mod(abs(hash(id::varchar)), 16) in (1, 3)"
+            " or mod(abs(hash(id::varchar)), 256) in (18)",
+        )
+
+    def test_compare_partitions_matches_compare_df(self):
+        prod_df = pd.DataFrame(
+            {"A": [str(i) for i in range(10)], "B": [str(i) for i in range(10)]}
+        )
+        dev_df = pd.DataFrame(
+            {"A": [str(i) for i in range(1, 11)], "B": ["x"] + list("123456789")}
+        )
+        expected = _compare_df(prod_df, dev_df, "prod", "dev", "A")
+
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            for name, df in (("prod", prod_df), ("dev", dev_df)):
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                rows = _spill_batches(
+                    batches=[table.slice(0, 4), table.slice(4)],
+                    directory=directory / name,
+                    primary_key="A",
+                    partitions=3,
+                )
+                self.assertEqual(rows, 10)
+            diffs = list(
+                _compare_partitions(
+                    directory=directory,
+                    prod_name="prod",
+                    dev_name="dev",
+                    primary_key="A",
+                    partitions=3,
+                )
+            )
+
+        result = pd.concat(diffs)
+        self.assertEqual(len(result), len(expected))
+        self.assertTrue(result.reindex(expected.index).equals(expected))
+
+    def test_spill_typed_batches_narrowed_per_chunk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            prod_batches = [
+                pa.table({"ID": pa.array([-1, 2], pa.int8()), "N": [1, 2]}),
+                pa.table({"ID": pa.array([300], pa.int16()), "N": [3]}),
+            ]
+            dev_batches = [
+                pa.table({"ID": pa.array([-1, 2, 300], pa.int64()), "N": [1, 2, 4]})
+            ]
+            for name, batches in (("prod", prod_batches), ("dev", dev_batches)):
+                rows = _spill_batches(
+                    batches=batches,
+                    directory=directory / name,
+                    primary_key="ID",
+                    partitions=4,
+                )
+                self.assertEqual(rows, 3)
+            result = pd.concat(
+                _compare_partitions(
+                    directory=directory,
+                    prod_name="prod",
+                    dev_name="dev",
+                    primary_key="ID",
+                    partitions=4,
+                    typed=True,
+                )
+            )
+
+        # Only the changed row differs, the negative key is found on both sides
+        self.assertEqual(list(result.index.get_level_values(0)), [300, 300])
+        self.assertEqual(list(result["N"]), [3, 4])
+
+    def test_query_builder_typed_only_casts_differing_types(self):
+        table_desc = [
+            {"name": "ID", "type": "NUMBER(38,0)"},
+            {"name": "B", "type": "TIMESTAMP_NTZ(9)"},
+            {"name": "C", "type": "VARCHAR(10)"},
+        ]
+        compare_to_desc = [
+            {"name": "ID", "type": "NUMBER(38,0)"},
+            {"name": "B", "type": "TIMESTAMP_NTZ(3)"},
+            {"name": "C", "type": "NUMBER(38,0)"},
+        ]
+
+        prod_query, dev_query = _query_builder(
+            table="prod.s.t",
+            compare_to="dev.s.t",
+            columns=None,
+            ignore_columns=None,
+            primary_key="ID",
+            table_desc=table_desc,
+            compare_to_desc=compare_to_desc,
+            typed=True,
+        )
+
+        self.assertIn("select\nb,\nc::varchar as c,\nid\nfrom prod.s.t", prod_query)
+
+    def test_compare_df_with_arrow_dtypes(self):
+        prod_df = pd.DataFrame(
+            {"a": [1, 2, 3], "b": [4, 5, 6]}, dtype=pd.ArrowDtype(pa.int64())
+        )
+        dev_df = pd.DataFrame(
+            {"a": [1, 2, 3], "b": [4, 5, 7]}, dtype=pd.ArrowDtype(pa.int64())
+        )
+
+        result = _compare_df(prod_df, dev_df, "prod", "dev", "a")
+
+        self.assertEqual(result["b"].tolist(), [6, 7])
+        self.assertEqual(result.index.get_level_values(0).tolist(), [3, 3])
+
+    def test_compare_df_matches_dataframe_compare_layout(self):
+        prod_df = pd.DataFrame(
+            {"a": [4, 1, 2, 3], "b": [1, 2, 3, 4], "c": ["x", None, "z", "w"]}
+        )
+        dev_df = pd.DataFrame(
+            {"a": [1, 2, 3, 5], "b": [2, 3, 5, 6], "c": [None, "y", "w", "v"]}
+        )
+        keys = [1, 2, 3, 4, 5]
+        expected = (
+            prod_df.set_index("a")
+            .reindex(keys)
+            .compare(
+                dev_df.set_index("a").reindex(keys),
+                align_axis=0,
+                result_names=("prod", "dev"),
+            )
+        )
+
+        result = _compare_df(prod_df, dev_df, "prod", "dev", "a")
+
+        self.assertTrue(result.equals(expected))
+        self.assertEqual(list(result.columns), ["b", "c"])
+
+    def test_compare_df_with_composite_primary_key(self):
+        prod_df = pd.DataFrame({"a": [1, 1, 2], "b": [1, 2, 1], "c": [4, 5, 6]})
+        dev_df = pd.DataFrame({"a": [1, 1, 2], "b": [2, 1, 2], "c": [5, 4, 6]})
+
+        result = _compare_df(prod_df, dev_df, "prod", "dev", ["a", "b"])
+        expected = pd.DataFrame(
+            {
+                "a": [2, 2, 2, 2],
+                "b": [1, 1, 2, 2],
+                "c": [6.0, None, None, 6.0],
+                "result_name": ["prod", "dev", "prod", "dev"],
+            }
+        ).set_index(["a", "b", "result_name"])
+        self.assertTrue(result.equals(expected))
+
+    def test_join_diff_query_builder_with_composite_primary_key(self):
+        desc = [{"name": "ID"}, {"name": "LINE"}, {"name": "B"}]
+
+        query = _join_diff_query_builder(
+            table="prod.s.t",
+            compare_to="dev.s.t",
+            columns=("b",),
+            ignore_columns=None,
+            primary_key=["ID", "LINE"],
+            table_desc=desc,
+            compare_to_desc=desc,
+        )
+
+        self.assertIn("on a.id = b.id and a.line = b.line", query)
+        self.assertIn("coalesce(a.line, b.line)::varchar as line", query)
+        self.assertIn("equal_null(a.line::varchar, b.line::varchar)", query)
+
+    def test_query_builder_with_where_on_both_sides(self):
+        desc = [{"name": "ID"}]
+
+        prod_query, dev_query = _query_builder(
+            table="prod.s.t",
+            compare_to="dev.s.t",
+            columns=None,
+            ignore_columns=None,
+            primary_key="ID",
+            table_desc=desc,
+            compare_to_desc=desc,
+            where="id > 10",
+        )
+
+        self.assertEqual(prod_query.count("\nwhere id > 10"), 2)
+        self.assertEqual(dev_query.count("\nwhere id > 10"), 2)
+
+    def test_sample_predicate(self):
+        result = _sample_predicate(["ID", "LINE"], 2.5)
+
+        self.assertEqual(
+            result,
+            "mod(abs(hash(id::varchar, line::varchar)), 1000000) < 25000",
+        )
+        self.assertTrue(_sample_predicate(["ID"], 0.00001).endswith("< 1"))
+
+    def test_summary_query_builder_only_deltas_for_numeric_columns(self):
+        table_desc = [
+            {"name": "ID", "type": "NUMBER(38,0)"},
+            {"name": "AMOUNT", "type": "NUMBER(38,2)"},
+            {"name": "NAME", "type": "VARCHAR(100)"},
+        ]
+
+        query, metrics = _summary_query_builder(
+            table="prod.s.t",
+            compare_to="dev.s.t",
+            columns=None,
+            ignore_columns=None,
+            primary_key="ID",
+            table_desc=table_desc,
+            compare_to_desc=table_desc,
+        )
+
+        self.assertEqual(
+            metrics,
+            [
+                ("amount", "mismatches"),
+                ("amount", "null_mismatches"),
+                ("amount", "min_delta"),
+                ("amount", "max_delta"),
+                ("name", "mismatches"),
+                ("name", "null_mismatches"),
+            ],
+        )
+        self.assertEqual(query.count("count_if("), 6)
+        self.assertIn("max(b.amount - a.amount)", query)
+        self.assertNotIn("b.name - a.name", query)
+
+    def test_summary_df(self):
+        metrics = [
+            ("a", "mismatches"),
+            ("a", "null_mismatches"),
+            ("b", "mismatches"),
+            ("b", "null_mismatches"),
+            ("b", "min_delta"),
+            ("b", "max_delta"),
+        ]
+
+        result = _summary_df(values=(1, 0, 3, 1, -2, 5), metrics=metrics)
+
+        self.assertEqual(list(result.index), ["b", "a"])
+        self.assertEqual(result.loc["b"].tolist(), [3, 1, -2, 5])
+        self.assertTrue(pd.isna(result.loc["a", "min_delta"]))
+
+    def test_read_tables_file(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("# models\ndb.s.a\n\ndb.s.b  id,line\n")
+            f.flush()
+
+            result = _read_tables_file(f.name)
+
+        self.assertEqual(result, [("db.s.a", None), ("db.s.b", "id,line")])
+
+    def test_diff_counts_without_primary_key(self):
+        desc = [{"name": "ID", "type": "NUMBER(38,0)"}]
+        results = {
+            "fingerprint": [
+                {"SIDE": "table", "ROW_COUNT": 3, "FINGERPRINT": 1},
+                {"SIDE": "compare_to", "ROW_COUNT": 3, "FINGERPRINT": 2},
+            ],
+            "table_except": [(1,)],
+            "compare_to_except": [(2,)],
+        }
+
+        def async_result(ctx, query_id, cursor_class=None):
+            cursor = mock.Mock()
+            cursor.fetchall.return_value = results[query_id]
+            cursor.fetchone.return_value = results[query_id][0]
+            return cursor
+
+        with mock.patch("vdc.diff._desc", return_value=[desc, desc]), mock.patch(
+            "vdc.diff._execute_async",
+            side_effect=[["fingerprint"], ["table_except", "compare_to_except"]],
+        ), mock.patch("vdc.diff._async_result", side_effect=async_result), mock.patch(
+            "vdc.diff._declared_primary_key"
+        ) as declared_primary_key:
+            result = _diff_counts(
+                ctx=None,
+                table="db.s.a",
+                compare_to="dev_db.s.a",
+                primary_key=None,
+                columns=None,
+                ignore_columns=None,
+            )
+
+        declared_primary_key.assert_not_called()
+        self.assertEqual(result["status"], "different")
+        self.assertEqual(result["table_rows_different"], 1)
+        self.assertEqual(result["compare_to_rows_different"], 2)
+
+
+def _bucket_row(bucket, side, rows, fingerprint):
+    return {
+        "BUCKET": bucket,
+        "SIDE": side,
+        "ROW_COUNT": rows,
+        "FINGERPRINT": fingerprint,
+    }
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,185 @@
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from vdc import manifest as manifest_module
+from vdc.manifest import (
+    _dag_levels,
+    _modified_nodes,
+    _nodes_in_files,
+    _project_fingerprint,
+    _stream_db_objects,
+    _with_downstream,
+    changed_relations,
+    load_db_objects,
+)
+
+
+def _node(name, checksum="a", materialized="table", patch_path=None):
+    return {
+        "resource_type": "model",
+        "relation_name": f"db.schema.{name}",
+        "original_file_path": f"models/{name}.sql",
+        "patch_path": patch_path,
+        "checksum": {"name": "sha256", "checksum": checksum},
+        "config": {"materialized": materialized},
+    }
+
+
+def _manifest(nodes, edges):
+    child_map = {unique_id: [] for unique_id in nodes}
+    parent_map = {unique_id: [] for unique_id in nodes}
+    for parent, child in edges:
+        child_map[parent].append(child)
+        parent_map[child].append(parent)
+    return {"nodes": nodes, "child_map": child_map, "parent_map": parent_map}
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        # a -> eph -> c -> d, b is unrelated
+        self.manifest = _manifest(
+            {
+                "model.p.a": _node("a", checksum="new"),
+                "model.p.b": _node("b", patch_path="p://models/schema.yml"),
+                "model.p.eph": _node("eph", materialized="ephemeral"),
+                "model.p.c": _node("c"),
+                "model.p.d": _node("d"),
+                "model.p.new": _node("new"),
+            },
+            [
+                ("model.p.a", "model.p.eph"),
+                ("model.p.eph", "model.p.c"),
+                ("model.p.c", "model.p.d"),
+            ],
+        )
+        self.base_manifest = _manifest(
+            {
+                "model.p.a": _node("a"),
+                "model.p.b": _node("b"),
+                "model.p.eph": _node("eph", materialized="ephemeral"),
+                "model.p.c": _node("c"),
+                "model.p.d": _node("d"),
+            },
+            [],
+        )
+
+    def test_modified_nodes(self):
+        self.assertEqual(
+            _modified_nodes(self.manifest, self.base_manifest), {"model.p.a"}
+        )
+
+    def test_nodes_in_files(self):
+        self.assertEqual(
+            _nodes_in_files(self.manifest, ["models/a.sql", "models/schema.yml"]),
+            {"model.p.a", "model.p.b"},
+        )
+
+    def test_with_downstream_skips_ephemeral(self):
+        self.assertEqual(
+            _with_downstream(self.manifest, ["model.p.a"]),
+            {"model.p.a", "model.p.c", "model.p.d"},
+        )
+
+    def test_dag_levels(self):
+        self.assertEqual(
+            _dag_levels(self.manifest, ["model.p.d", "model.p.c", "model.p.b"]),
+            [["model.p.b", "model.p.c"], ["model.p.d"]],
+        )
+
+    def test_changed_relations(self):
+        self.assertEqual(
+            changed_relations(self.manifest, base_manifest=self.base_manifest),
+            [["db.schema.a"], ["db.schema.c"], ["db.schema.d"]],
+        )
+
+
+class TestManifestIndex(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        patcher = mock.patch.object(
+            manifest_module, "INDEX_DIR", self.directory / "index"
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.path = self.directory / "manifest.json"
+        self.path.write_text(
+            json.dumps(
+                {
+                    "metadata": {"generated_at": "2024-01-01"},
+                    "nodes": {
+                        "model.p.a": {
+                            "resource_type": "model",
+                            "config": {"database": "other", "tags": ["x"]},
+                            "database": "DB",
+                            "relation_name": "DB.S.A",
+                            "compiled_code": "select 1",
+                        },
+                        "model.p.eph": {
+                            "resource_type": "model",
+                            "database": "DB",
+                            "relation_name": None,
+                        },
+                        "test.p.t": {
+                            "resource_type": "test",
+                            "database": "DB",
+                            "relation_name": "DB.S.T",
+                        },
+                    },
+                    "sources": {
+                        "source.p.raw.b": {
+                            "resource_type": "source",
+                            "database": "RAW",
+                            "relation_name": "RAW.S.B",
+                        }
+                    },
+                    "child_map": {"model.p.a": ["test.p.t"]},
+                }
+            )
+        )
+
+    def test_stream_db_objects(self):
+        self.assertEqual(
+            _stream_db_objects(self.path), ({"db.s.a", "raw.s.b"}, {"DB", "RAW"})
+        )
+
+    def test_load_db_objects_uses_index(self):
+        expected = ({"db.s.a", "raw.s.b"}, {"DB", "RAW"})
+        self.assertEqual(load_db_objects(self.path), expected)
+        with mock.patch.object(manifest_module, "_stream_db_objects") as stream:
+            self.assertEqual(load_db_objects(self.path), expected)
+            # Same content, new mtime
+            os.utime(self.path, ns=(0, 0))
+            self.assertEqual(load_db_objects(self.path), expected)
+            stream.assert_not_called()
+
+
+class TestProjectFingerprint(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.project = Path(directory.name)
+        (self.project / "models").mkdir()
+        (self.project / "target").mkdir()
+        (self.project / "dbt_project.yml").write_text("name: p")
+        (self.project / "models" / "a.sql").write_text("select 1")
+
+    def fingerprint(self, target="prod"):
+        return _project_fingerprint(self.project, self.project, target)
+
+    def test_ignores_generated_files(self):
+        fingerprint = self.fingerprint()
+        (self.project / "target" / "manifest.json").write_text("{}")
+        (self.project / ".user.yml").write_text("id: 1")
+        self.assertEqual(self.fingerprint(), fingerprint)
+
+    def test_changes_with_project_and_target(self):
+        fingerprint = self.fingerprint()
+        self.assertNotEqual(self.fingerprint(target="dev"), fingerprint)
+        (self.project / "models" / "a.sql").write_text("select 2")
+        self.assertNotEqual(self.fingerprint(), fingerprint)
@@ -0,0 +1,82 @@
+import tempfile
+import unittest
+import zipfile
+from pathlib import Path
+from unittest import mock
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from vdc.diff import _compare_df
+from vdc.report import open_report
+
+
+class TestReport(unittest.TestCase):
+
+    def setUp(self):
+        prod_df = pd.DataFrame({"A": ["1", "2"], "B": ["x", "y"], "C": ["1", "1"]})
+        dev_df = pd.DataFrame({"A": ["1", "2"], "B": ["x", "z"], "C": ["2", "1"]})
+        self.diff = _compare_df(prod_df, dev_df, "prod", "dev", "A")
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_csv_batches_line_up_with_given_columns(self):
+        path = Path(self.directory.name) / "diff.csv"
+
+        with open_report(path, columns=["B", "C"]) as report:
+            report.write(self.diff[["C"]])
+            report.write(self.diff[["B"]])
+
+        result = pd.read_csv(path, dtype=str)
+        self.assertEqual(list(result.columns), ["A", "table", "B", "C"])
+        self.assertEqual(len(result), 8)
+        self.assertEqual(report.rows, 8)
+
+    def test_parquet_writes_one_row_group_per_batch(self):
+        path = Path(self.directory.name) / "diff.parquet"
+
+        with open_report(path) as report:
+            report.write(self.diff)
+            report.write(self.diff)
+
+        self.assertEqual(pq.ParquetFile(path).num_row_groups, 2)
+        self.assertEqual(pq.read_table(path).num_rows, 8)
+
+    def test_parquet_batches_with_different_differing_columns(self):
+        path = Path(self.directory.name) / "diff.parquet"
+        prod_df = pd.DataFrame({"ID": ["1", "2"], "A": ["x", "y"], "B": ["s", "t"]})
+        only_a = pd.DataFrame({"ID": ["1", "2"], "A": ["x", "z"], "B": ["s", "t"]})
+        only_b = pd.DataFrame({"ID": ["1", "2"], "A": ["x", "y"], "B": ["s", "u"]})
+
+        with open_report(path, columns=["A", "B"]) as report:
+            report.write(_compare_df(prod_df, only_a, "prod", "dev", "ID"))
+            report.write(_compare_df(prod_df, only_b, "prod", "dev", "ID"))
+
+        result = pq.read_table(path).to_pandas()
+        self.assertEqual(list(result["A"]), ["y", "z", None, None])
+        self.assertEqual(list(result["B"]), [None, None, "t", "u"])
+
+    def test_excel_rolls_over_to_new_sheet(self):
+        path = Path(self.directory.name) / "diff.xlsx"
+
+        with mock.patch("vdc.report.EXCEL_MAX_ROWS", 3):
+            with open_report(path) as report:
+                report.write(self.diff)
+                report.write(self.diff)
+
+        sheets = [
+            name
+            for name in zipfile.ZipFile(path).namelist()
+            if name.startswith("xl/worksheets/sheet")
+        ]
+        self.assertEqual(len(sheets), 4)
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            open_report(Path(self.directory.name) / "diff.json")
+
+
+if __name__ == "__main__":
+    unittest.main()
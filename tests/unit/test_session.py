@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from vdc import session
+from vdc.session import SessionPool
+
+
+class TestSessionPool(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("vdc.session.snowflake.connector.connect")
+        self.connect = patcher.start()
+        self.connect.side_effect = lambda **kwargs: mock.MagicMock(
+            is_closed=mock.MagicMock(return_value=False)
+        )
+        self.addCleanup(patcher.stop)
+
+    def test_connects_lazily_and_reuses_connection(self):
+        pool = SessionPool({"user": "u", "password": None})
+        self.connect.assert_not_called()
+        ctx = pool.connection()
+        self.assertIs(pool.connection(), ctx)
+        self.connect.assert_called_once_with(user="u")
+
+    def test_reconnects_closed_connection(self):
+        pool = SessionPool({"user": "u"})
+        ctx = pool.connection()
+        ctx.is_closed.return_value = True
+        self.assertIsNot(pool.connection(), ctx)
+        self.assertEqual(self.connect.call_count, 2)
+
+    def test_round_robin(self):
+        pool = SessionPool({"user": "u"}, size=2)
+        first, second, third = (pool.connection() for _ in range(3))
+        self.assertIsNot(first, second)
+        self.assertIs(first, third)
+        pool.close()
+        first.close.assert_called_once()
+        second.close.assert_called_once()
+
+
+class FakeTokenCache:
+    def __init__(self):
+        self.tokens = {}
+
+    def store(self, key, token):
+        self.tokens[key.string_key()] = token
+
+    def retrieve(self, key):
+        return self.tokens.get(key.string_key())
+
+    def remove(self, key):
+        self.tokens.pop(key.string_key(), None)
+
+
+class TestSharedSession(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(
+            session, "SESSION_FILE", Path(directory.name) / "session.json"
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.token_cache = FakeTokenCache()
+        patcher = mock.patch.object(
+            session.TokenCache, "make", return_value=self.token_cache
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.config = {"account": "a", "user": "u", "role": "r", "warehouse": "w"}
+        self.session = {
+            **self.config,
+            "host": "a.snowflakecomputing.com",
+            "session_token": "session",
+            "master_token": "master",
+        }
+
+    def test_no_session(self):
+        self.assertIsNone(session._read_shared_session(self.config))
+
+    def test_running_session(self):
+        session._write_session({**self.session, "pid": os.getpid()})
+        self.assertEqual(session.SESSION_FILE.stat().st_mode & 0o777, 0o600)
+        # Only the token cache holds the tokens
+        self.assertNotIn("master_token", session._read_session_file())
+        self.assertNotIn("session_token", session._read_session_file())
+        shared_session = session._read_shared_session(self.config)
+        self.assertEqual(shared_session["pid"], os.getpid())
+        self.assertEqual(shared_session["session_token"], "session")
+        self.assertEqual(shared_session["master_token"], "master")
+        self.assertIsNone(
+            session._read_shared_session({**self.config, "role": "other"})
+        )
+
+    def test_session_without_tokens(self):
+        session._write_session({**self.session, "pid": os.getpid()})
+        session._remove_tokens(self.session)
+        self.assertIsNone(session._read_shared_session(self.config))
+
+    def test_stopped_session(self):
+        with mock.patch.object(session, "_is_running", return_value=False):
+            session._write_session({**self.session, "pid": 1})
+            self.assertIsNone(session._read_shared_session(self.config))
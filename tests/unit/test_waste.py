@@ -0,0 +1,150 @@
+import datetime
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from vdc import manifest
+from vdc.waste import (
+    _create_dbt_manifest,
+    _find_candidate_tables,
+    _format_bytes,
+    _rank_candidate_tables,
+    _tables_query,
+)
+
+
+class TestWaste(unittest.TestCase):
+    def test_tables_query_is_one_union_all_query(self):
+        query = _tables_query(databases={"b", "a"}, schemas={"'S'", "'R'"})
+        self.assertEqual(query.count("union all"), 1)
+        self.assertLess(
+            query.index("from a.information_schema"),
+            query.index("from b.information_schema"),
+        )
+        self.assertEqual(query.count("table_schema in ('R','S')"), 2)
+
+    def test_find_candidate_tables(self):
+        tables = [
+            _table("DB", "S", "UNUSED", "2024-02-01"),
+            _table("DB", "S", "MODEL"),
+            _table("DB", "S", "SNAPSHOT"),
+            _table("DB", "S", "IGNORED"),
+            _table("DB", "S", "OLD_BCK_USER_DRP_202401"),
+            _table("DB", "PUBLIC", "ANYTHING"),
+            _table("DB", "S", "A_UNUSED"),
+        ]
+        self.assertEqual(
+            _find_candidate_tables(
+                tables,
+                dbt_tables={"db.s.model", "db.s.snapshot__transient"},
+                ignore_tables=["db.s.ignored"],
+            ),
+            [
+                {"name": "db.s.a_unused", "last_altered": "2024-01-01"},
+                {"name": "db.s.unused", "last_altered": "2024-02-01"},
+            ],
+        )
+
+    def test_rank_candidate_tables(self):
+        now = datetime.datetime(2024, 6, 1, tzinfo=datetime.timezone.utc)
+        candidates = [
+            {"name": "db.s.small", "last_altered": "2024-01-01"},
+            {"name": "db.s.large", "last_altered": "2024-01-01"},
+            {"name": "db.s.read", "last_altered": "2024-01-01"},
+            {"name": "db.s.no_usage", "last_altered": "2024-01-01"},
+        ]
+        usage = [
+            _usage("db.s.small", active=10),
+            _usage("db.s.large", active=100, time_travel=50, failsafe=None),
+            _usage("db.s.read", active=1000, last_read=now - datetime.timedelta(1)),
+        ]
+        self.assertEqual(
+            [
+                (table["name"], table["reclaimable_bytes"])
+                for table in _rank_candidate_tables(candidates, usage, now)
+            ],
+            [
+                ("db.s.read", 1000),
+                ("db.s.large", 150),
+                ("db.s.small", 10),
+                ("db.s.no_usage", 0),
+            ],
+        )
+        self.assertEqual(
+            [
+                table["name"]
+                for table in _rank_candidate_tables(
+                    candidates, usage, now, min_bytes=10, unread_days=30
+                )
+            ],
+            ["db.s.large", "db.s.small"],
+        )
+
+    def test_format_bytes(self):
+        self.assertEqual(_format_bytes(512), "512 B")
+        self.assertEqual(_format_bytes(1536), "1.5 KiB")
+        self.assertEqual(_format_bytes(3 * 1024**5), "3072.0 TiB")
+
+
+def _usage(name, active=0, time_travel=0, failsafe=0, last_read=None):
+    return {
+        "NAME": name,
+        "ACTIVE_BYTES": active,
+        "TIME_TRAVEL_BYTES": time_travel,
+        "FAILSAFE_BYTES": failsafe,
+        "LAST_READ": last_read,
+    }
+
+
+def _table(catalog, schema, name, last_altered="2024-01-01"):
+    return {
+        "TABLE_CATALOG": catalog,
+        "TABLE_SCHEMA": schema,
+        "TABLE_NAME": name,
+        "LAST_ALTERED": last_altered,
+    }
+
+
+class TestCreateDbtManifest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.project = Path(directory.name) / "dbt"
+        (self.project / "models").mkdir(parents=True)
+        (self.project / "models" / "a.sql").write_text("select 1")
+        (self.project / "packages.yml").write_text("packages: []")
+        patcher = mock.patch.object(
+            manifest, "STATE_DIR", Path(directory.name) / "state"
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run_dbt(self, command, dbt_project_dir, **kwargs):
+        self.commands.append(command)
+        if command == "deps":
+            (self.project / "dbt_packages").mkdir(exist_ok=True)
+        if command == "parse":
+            (self.project / "target").mkdir(exist_ok=True)
+            (self.project / "target" / "manifest.json").write_text('{"nodes": {}}')
+
+    def create_manifest(self):
+        self.commands = []
+        with mock.patch("vdc.waste._run_dbt", side_effect=self._run_dbt):
+            _create_dbt_manifest(
+                dbt_project_dir=str(self.project), dbt_profile_dir=str(self.project)
+            )
+        return self.commands
+
+    def test_skips_dbt_when_manifest_is_fresh(self):
+        self.assertEqual(self.create_manifest(), ["deps", "parse"])
+        self.assertEqual(self.create_manifest(), [])
+        (self.project / "models" / "a.sql").write_text("select 2")
+        self.assertEqual(self.create_manifest(), ["parse"])
+
+    def test_runs_dbt_when_manifest_is_overwritten(self):
+        self.assertEqual(self.create_manifest(), ["deps", "parse"])
+        # e.g. dbt run --target dev
+        (self.project / "target" / "manifest.json").write_text('{"nodes": {"dev": {}}}')
+        self.assertEqual(self.create_manifest(), ["parse"])
+        self.assertEqual(self.create_manifest(), [])
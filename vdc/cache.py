@@ -0,0 +1,119 @@
+import pickle
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional
+
+from vdc import utils
+
+CACHE_FILE = utils.CACHE_DIR / "metadata.sqlite"
+DEFAULT_TTL = 600
+# Scope of results that span the whole account, e.g. show ... in account.
+# They are invalidated together with any database.
+ACCOUNT_SCOPE = "*"
+
+
+class MetadataCache:
+    """Query results cached on disk in SQLite for `ttl` seconds.
+
+    Every entry is tagged with the database it describes, or ACCOUNT_SCOPE, so
+    commands that change a database can invalidate what is cached about it. A
+    ttl of 0 disables the cache.
+    """
+
+    def __init__(self, path: Path = CACHE_FILE, ttl: int = DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute(
+            "create table if not exists entries "
+            "(key text primary key, scope text not null, created real not null, value blob not null)"
+        )
+        return db
+
+    def get(self, key: str) -> Optional[Any]:
+        if not self.ttl:
+            return None
+        with closing(self._connect()) as db:
+            row = db.execute(
+                "select value from entries where key = ? and created > ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, key: str, value: Any, scope: str):
+        if not self.ttl:
+            return
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "insert or replace into entries values (?, ?, ?, ?)",
+                (key, scope.lower(), time.time(), pickle.dumps(value)),
+            )
+
+    def invalidate(self, databases: Iterable[str]):
+        scopes = [ACCOUNT_SCOPE] + [database.lower() for database in databases]
+        with closing(self._connect()) as db, db:
+            db.execute(
+                f"delete from entries where scope in ({','.join('?' * len(scopes))})",
+                scopes,
+            )
+
+    def clear(self):
+        with closing(self._connect()) as db, db:
+            db.execute("delete from entries")
+
+
+def metadata_cache() -> MetadataCache:
+    ttl = (utils.config or {}).get("metadata_cache_ttl", DEFAULT_TTL)
+    return MetadataCache(ttl=ttl)
+
+
+def _key(key: str) -> str:
+    # Other accounts and roles see other objects
+    snowflake_config = (utils.config or {}).get("snowflake", {})
+    return f"{snowflake_config.get('account')}/{snowflake_config.get('role')}/{key}"
+
+
+def get(key: str) -> Optional[Any]:
+    return metadata_cache().get(_key(key))
+
+
+def put(key: str, value: Any, scope: str):
+    metadata_cache().set(_key(key), value, scope)
+
+
+def cached_query(cursor, query: str, scope: str) -> list:
+    """fetchall() of the query, served from the metadata cache when possible"""
+    return list(stream_cached_query(cursor, query, scope))
+
+
+def stream_cached_query(
+    cursor, query: str, scope: str, batch_size: int = 10000
+) -> Iterator:
+    """Rows of the query, served from the metadata cache when possible.
+
+    Otherwise rows are yielded batch by batch as they are fetched, and cached
+    when all rows are fetched.
+    """
+    rows = get(query)
+    if rows is not None:
+        yield from rows
+        return
+    rows = []
+    cursor.execute(query)
+    while batch := cursor.fetchmany(batch_size):
+        rows += batch
+        yield from batch
+    put(query, rows, scope)
+
+
+def invalidate(*objects: str):
+    """Invalidate what is cached about the databases of the given objects,
+    e.g. db, db.schema or db.schema.table"""
+    metadata_cache().invalidate(obj.split(".")[0] for obj in objects)
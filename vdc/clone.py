@@ -1,70 +1,561 @@
 import logging
-import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
 
-import snowflake.connector
+import yaml
+from alive_progress import alive_bar
 from snowflake.connector import DictCursor
+from snowflake.connector.errors import Error
 
+from vdc import cache, session
 from vdc.utils import _spinner
 
 LOGGER = logging.getLogger(__file__)
 
 
-def _snow_config():
-    return {
-        "user": os.environ["DBT_USR"],
-        "authenticator": "externalbrowser",
-        "account": "wx23413.europe-west4.gcp",
-        "role": "sysadmin",
-        "warehouse": "dev__xs",
-    }
+MAX_CONCURRENCY = 8
+POLL_INTERVAL = 0.1
+MAX_POLL_INTERVAL = 1.0
 
 
-class SnowflakeConnector:
-    def __init__(self):
-        self.cur = snowflake.connector.connect(**_snow_config()).cursor(DictCursor)
+def _clone_database(
+    ctx,
+    src: str,
+    dst: str,
+    usage: tuple[str] = (),
+    max_concurrency: int = MAX_CONCURRENCY,
+) -> list[dict]:
+    """Clone src to dst, then suspend its dynamic tables and grant usage to the
+    roles. Returns the result of every statement, see _run_concurrently.
 
-    def run_query(self, query: str) -> list[dict]:
-        result = self.cur.execute(query)
-        return result
+    Raises ValueError if src does not exist.
+    """
+    cur = ctx.cursor(DictCursor)
+    cur.execute("use role sysadmin")
+    transient = _transient(cur, src)
 
+    create_sql = f"create or replace {transient}database {dst} clone {src}"
+    started = time.monotonic()
+    cur.execute(create_sql)
+    results = [
+        {"statement": create_sql, "seconds": time.monotonic() - started, "error": None}
+    ]
+
+    dynamic_tables = cur.execute(f"show dynamic tables in database {dst}").fetchall()
+    # Suspend first, cloned dynamic tables start refreshing right away
+    statements = _suspend_dynamic_tables(
+        db=dst, dynamic_tables=dynamic_tables
+    ) + _grant_usage(db=dst, roles=usage)
+    results += _run_concurrently(
+        ctx=ctx, statements=statements, max_concurrency=max_concurrency
+    )
+    cache.invalidate(dst)
+    return results
 
-def create_db_clone(src: str, dst: str, usage: tuple[str] = ()):
-    with _spinner("Creating database clone"):
-        prod_db = src
-        clone_db = dst
 
-        use_role = "use role sysadmin"
-        show_database = f"show databases like '{prod_db}'"
-        show_dynamic_tables = f"show dynamic tables in database {clone_db}"
+def create_db_clone(
+    src: str, dst: str, usage: tuple[str] = (), max_concurrency: int = MAX_CONCURRENCY
+) -> bool:
+    """Clone src to dst, suspend its dynamic tables and grant usage to the roles.
 
+    Returns False if anything failed.
+    """
+    with _spinner("Creating database clone"):
         try:
-            conn = SnowflakeConnector()
+            ctx = session.get_connection()
         except Exception as e:
             LOGGER.error(f"Error creating Snowflake connection. {e}")
-            return
+            return False
+        try:
+            results = _clone_database(
+                ctx=ctx, src=src, dst=dst, usage=usage, max_concurrency=max_concurrency
+            )
+        except (ValueError, Error) as e:
+            LOGGER.error(f"Error cloning {src} to {dst}. {e}")
+            return False
+    _print_statement_report(results)
+    return not any(result["error"] for result in results)
 
-        conn.run_query(use_role)
 
-        database_info = list(conn.run_query(show_database))
+def _transient(cur, database: str) -> str:
+    """'transient ' if the database is transient, else ''
 
-        if not database_info:
-            LOGGER.error(f"Source database {prod_db} not found")
-            return
+    Raises ValueError if the database does not exist.
+    """
+    database_info = cur.execute(f"show databases like '{database}'").fetchall()
+    if not database_info:
+        raise ValueError(f"Source database {database} not found")
+    return "transient " if database_info[0].get("options") == "TRANSIENT" else ""
+
+
+def _metadata_query(side: str, db: str, schemas: tuple[str] = ()) -> str:
+    """Schemas and tables of one database, tagged with side"""
+    schema_filter = ""
+    if schemas:
+        schema_filter = f" and {{column}} in ({', '.join(sorted({repr(schema.upper()) for schema in schemas}))})"
+    return (
+        f"select '{side}' as side, 'schema' as kind, schema_name as table_schema, null as table_name, null as table_type, is_transient, 'NO' as is_dynamic, last_altered, created "
+        f"from {db}.information_schema.schemata where schema_name != 'INFORMATION_SCHEMA'"
+        + schema_filter.format(column="schema_name")
+        + "\nunion all\n"
+        + f"select '{side}', 'table', table_schema, table_name, table_type, is_transient, is_dynamic, last_altered, created "
+        f"from {db}.information_schema.tables where table_schema != 'INFORMATION_SCHEMA'"
+        + schema_filter.format(column="table_schema")
+    )
+
+
+def _clone_metadata_query(src: str, dst: str, schemas: tuple[str] = ()) -> str:
+    """Schemas and tables of both databases in one query"""
+    return "\nunion all\n".join(
+        _metadata_query(side=side, db=db, schemas=schemas)
+        for side, db in [("source", src), ("target", dst)]
+    )
+
+
+def _clone_object_statement(kind: str, src: str, dst: str, row: dict) -> str:
+    transient = "transient " if row["IS_TRANSIENT"] == "YES" else ""
+    dynamic = "dynamic " if row["IS_DYNAMIC"] == "YES" else ""
+    return f"create or replace {transient}{dynamic}{kind} {dst} clone {src}"
+
+
+def _partial_clone_plan(
+    src: str,
+    dst: str,
+    rows: list[dict],
+    schemas: tuple[str] = (),
+    tables: tuple[str] = (),
+    refresh_stale: bool = False,
+) -> tuple[list[str], list[str], list[str], list[str]]:
+    """Schema creates, clone statements, dynamic table suspends and skipped
+    views for cloning the schemas or schema.tables of src into dst.
 
+    With refresh_stale only tables altered in src since they were cloned to
+    dst, and schemas or tables missing in dst, are cloned. Views cannot be
+    cloned on their own and are skipped. Tables cloned into a schema missing
+    in dst need the schema to be created first.
+    """
+    source_schemas, target_schemas, source_tables, target_tables = {}, {}, {}, {}
+    for row in rows:
+        schema = row["TABLE_SCHEMA"].lower()
+        if row["KIND"] == "schema":
+            side = source_schemas if row["SIDE"] == "source" else target_schemas
+            side[schema] = row
+        else:
+            side = source_tables if row["SIDE"] == "source" else target_tables
+            side[f"{schema}.{row['TABLE_NAME'].lower()}"] = row
+
+    selected_schemas = [schema.lower() for schema in schemas]
+    selected_tables = [table.lower() for table in tables]
+    for name in selected_schemas:
+        if name not in source_schemas:
+            raise ValueError(f"Schema {src}.{name} not found")
+    for name in selected_tables:
+        if name not in source_tables:
+            raise ValueError(f"Table {src}.{name} not found")
+    if refresh_stale and not selected_tables:
+        selected_schemas = selected_schemas or sorted(source_schemas)
+
+    creates, clones, suspends, views = [], [], [], []
+
+    def clone_table(name):
+        row = source_tables[name]
+        if row["TABLE_TYPE"] == "VIEW":
+            views.append(f"{src}.{name}")
+            return
+        schema = name.split(".")[0]
         transient = (
-            "transient " if database_info[0].get("options") == "TRANSIENT" else ""
+            "transient " if source_schemas[schema]["IS_TRANSIENT"] == "YES" else ""
         )
+        create = f"create {transient}schema if not exists {dst}.{schema}"
+        if schema not in target_schemas and create not in creates:
+            creates.append(create)
+        clones.append(
+            _clone_object_statement("table", f"{src}.{name}", f"{dst}.{name}", row)
+        )
+        if row["IS_DYNAMIC"] == "YES":
+            suspends.append(f"alter dynamic table {dst}.{name} suspend")
 
-        create_sql = f"create or replace {transient}database {clone_db} clone {prod_db}"
-        conn.run_query(create_sql)
+    for schema in selected_schemas:
+        if not refresh_stale or schema not in target_schemas:
+            clones.append(
+                _clone_object_statement(
+                    "schema",
+                    f"{src}.{schema}",
+                    f"{dst}.{schema}",
+                    source_schemas[schema],
+                )
+            )
+            suspends += [
+                f"alter dynamic table {dst}.{name} suspend"
+                for name, row in sorted(source_tables.items())
+                if name.split(".")[0] == schema and row["IS_DYNAMIC"] == "YES"
+            ]
+            continue
+        selected_tables += sorted(
+            name for name in source_tables if name.split(".")[0] == schema
+        )
 
-        dynamic_tables = conn.run_query(show_dynamic_tables)
-        for suspend_dynamic_table in _suspend_dynamic_tables(
-            db=clone_db, dynamic_tables=dynamic_tables
+    for name in selected_tables:
+        target = target_tables.get(name)
+        if (
+            refresh_stale
+            and target is not None
+            and source_tables[name]["LAST_ALTERED"] <= target["CREATED"]
         ):
-            conn.run_query(suspend_dynamic_table)
-        for grant_usage_to_role in _grant_usage(db=clone_db, roles=usage):
-            conn.run_query(grant_usage_to_role)
+            continue
+        clone_table(name)
+    return creates, clones, suspends, views
+
+
+def create_partial_clone(
+    src: str,
+    dst: str,
+    schemas: tuple[str] = (),
+    tables: tuple[str] = (),
+    refresh_stale: bool = False,
+    usage: tuple[str] = (),
+    max_concurrency: int = MAX_CONCURRENCY,
+) -> bool:
+    """Clone schemas or schema.tables of src into dst, keeping everything else
+    in dst. See _partial_clone_plan. Returns False if anything failed.
+    """
+    with _spinner("Creating clone"):
+        ctx = session.get_connection()
+        cur = ctx.cursor(DictCursor)
+        try:
+            cur.execute("use role sysadmin")
+            transient = _transient(cur, src)
+            cur.execute(f"create {transient}database if not exists {dst}")
+            rows = cur.execute(
+                _clone_metadata_query(
+                    src=src,
+                    dst=dst,
+                    schemas=tuple(schemas) + tuple(t.split(".")[0] for t in tables),
+                )
+            ).fetchall()
+            creates, clones, suspends, views = _partial_clone_plan(
+                src=src,
+                dst=dst,
+                rows=rows,
+                schemas=schemas,
+                tables=tables,
+                refresh_stale=refresh_stale,
+            )
+        except (ValueError, Error) as e:
+            LOGGER.error(f"Error cloning {src} to {dst}. {e}")
+            return False
+        # The schemas must exist before tables are cloned into them
+        results = _run_concurrently(
+            ctx=ctx, statements=creates, max_concurrency=max_concurrency
+        )
+        results += _run_concurrently(
+            ctx=ctx, statements=clones, max_concurrency=max_concurrency
+        )
+        # Suspend first, cloned dynamic tables start refreshing right away
+        results += _run_concurrently(
+            ctx=ctx,
+            statements=suspends + _grant_usage(db=dst, roles=usage),
+            max_concurrency=max_concurrency,
+        )
+        cache.invalidate(dst)
+    if views:
+        print(f"Skipped {len(views)} views, they cannot be cloned on their own")
+    if not clones:
+        print(f"Nothing to clone, {dst} is up to date")
+    _print_statement_report(results)
+    return not any(result["error"] for result in results)
+
+
+def _batched_metadata(ctx, queries: list[str]) -> list[list[dict]]:
+    """Results of the queries, sent as one multi statement request"""
+    cur = ctx.cursor(DictCursor)
+    cur.execute(";\n".join(queries), num_statements=len(queries))
+    results = [cur.fetchall()]
+    while cur.nextset():
+        results.append(cur.fetchall())
+    return results
+
+
+def _object_counts_query(db: str) -> str:
+    return (
+        "select count(distinct table_schema) as schemas, "
+        "count_if(table_type = 'BASE TABLE') as tables, "
+        "count_if(table_type = 'VIEW') as views, "
+        "count_if(is_dynamic = 'YES') as dynamic_tables "
+        f"from {db}.information_schema.tables where table_schema != 'INFORMATION_SCHEMA'"
+    )
+
+
+def plan_clone(
+    src: str,
+    dst: str,
+    schemas: tuple[str] = (),
+    tables: tuple[str] = (),
+    refresh_stale: bool = False,
+    usage: tuple[str] = (),
+    max_concurrency: int = MAX_CONCURRENCY,
+) -> bool:
+    """Print what cloning src to dst would do, without changing anything.
+
+    The metadata of src is fetched in one round trip. A partial clone into a
+    dst that exists takes one more round trip for the schemas and tables of
+    dst, as they cannot be queried in the same request without failing when
+    dst does not exist. Returns False if the metadata could not be fetched.
+    """
+    partial = schemas or tables or refresh_stale
+    clone_schemas = tuple(schemas) + tuple(t.split(".")[0] for t in tables)
+    queries = [
+        f"show databases like '{src}'",
+        _object_counts_query(src),
+        f"show dynamic tables in database {src}",
+    ]
+    if partial:
+        queries += [
+            f"show databases like '{dst}'",
+            _metadata_query(side="source", db=src, schemas=clone_schemas),
+        ]
+    with _spinner("Planning clone"):
+        try:
+            ctx = session.get_connection()
+            database_info, (counts,), dynamic_tables, *partial_info = _batched_metadata(
+                ctx=ctx, queries=queries
+            )
+            if not database_info:
+                raise ValueError(f"Source database {src} not found")
+            if partial:
+                dst_info, rows = partial_info
+                if dst_info:
+                    (target_rows,) = _batched_metadata(
+                        ctx=ctx,
+                        queries=[
+                            _metadata_query(
+                                side="target", db=dst, schemas=clone_schemas
+                            )
+                        ],
+                    )
+                    rows = rows + target_rows
+                creates, clones, suspends, views = _partial_clone_plan(
+                    src=src,
+                    dst=dst,
+                    rows=rows,
+                    schemas=schemas,
+                    tables=tables,
+                    refresh_stale=refresh_stale,
+                )
+        except (ValueError, Error) as e:
+            LOGGER.error(f"Error planning clone of {src} to {dst}. {e}")
+            return False
+
+    transient = "transient " if database_info[0].get("options") == "TRANSIENT" else ""
+    fixed = ["use role sysadmin", f"show databases like '{src}'"]
+    if partial:
+        fixed += [
+            f"create {transient}database if not exists {dst}",
+            "<schemas and tables of both databases from information_schema>",
+        ]
+        statements = creates + clones + suspends
+    else:
+        fixed += [
+            f"create or replace {transient}database {dst} clone {src}",
+            f"show dynamic tables in database {dst}",
+        ]
+        views = []
+        statements = _suspend_dynamic_tables(db=dst, dynamic_tables=dynamic_tables)
+    statements += _grant_usage(db=dst, roles=usage)
+
+    print(f"Clone {src} to {dst}")
+    print(
+        f"{src} has {counts['SCHEMAS']} schemas, {counts['TABLES']} tables of which "
+        f"{counts['DYNAMIC_TABLES']} are dynamic, and {counts['VIEWS']} views"
+    )
+    active = [
+        dynamic_table
+        for dynamic_table in dynamic_tables
+        if dynamic_table["scheduling_state"] != "SUSPENDED"
+    ]
+    if active:
+        print(f"\n{len(active)} dynamic tables refresh in {src}:")
+        for dynamic_table in active:
+            print(
+                f"  {dynamic_table['schema_name']}.{dynamic_table['name']}  "
+                f"target lag {dynamic_table['target_lag']}, warehouse {dynamic_table['warehouse']}"
+            )
+    if views:
+        print(f"\nSkipped {len(views)} views, they cannot be cloned on their own")
+    print("\nStatements:")
+    for statement in fixed:
+        print(f"  {statement}")
+    for statement in statements:
+        print(f"  {statement}  (async)")
+    # Every async statement is one request to submit it and at least one to
+    # poll its status
+    round_trips = len(fixed) + 2 * len(statements)
+    print(
+        f"\n{len(fixed) + len(statements)} statements in about {round_trips} round trips, "
+        f"with at most {max_concurrency} async statements running at a time"
+    )
+    return True
+
+
+def _clone_pairs(databases: tuple[str]) -> list[tuple[str, str]]:
+    """(src, dst) pairs from either DB TO or any number of SRC:DST"""
+    if len(databases) == 2 and not any(":" in database for database in databases):
+        return [(databases[0], databases[1])]
+    pairs = []
+    for database in databases:
+        src, sep, dst = database.partition(":")
+        if not sep or not src or not dst:
+            raise ValueError(f"Expected SRC:DST, got {database}")
+        pairs.append((src, dst))
+    return pairs
+
+
+def _read_clone_mapping(path: str) -> list[tuple[str, str]]:
+    """(src, dst) pairs from a yaml file mapping source to destination database"""
+    mapping = yaml.safe_load(Path(path).read_text()) or {}
+    if not isinstance(mapping, dict):
+        raise ValueError(f"{path} must map source databases to destination databases")
+    return [(str(src), str(dst)) for src, dst in mapping.items()]
+
+
+def _clone_order(pairs: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    """The pairs ordered so a database is cloned after the clone it is cloned from.
+
+    Raises ValueError if a database is a destination more than once, or the
+    pairs depend on each other in a cycle.
+    """
+    destinations = [dst.lower() for _, dst in pairs]
+    duplicates = {dst for dst in destinations if destinations.count(dst) > 1}
+    if duplicates:
+        raise ValueError(f"Cloned to more than once: {', '.join(sorted(duplicates))}")
+    ordered = []
+    done = set()
+    pending = list(pairs)
+    while pending:
+        ready = [
+            (src, dst)
+            for src, dst in pending
+            if src.lower() not in destinations or src.lower() in done
+        ]
+        if not ready:
+            raise ValueError(
+                f"Clones depend on each other: {', '.join(f'{src}:{dst}' for src, dst in pending)}"
+            )
+        ordered += ready
+        done.update(dst.lower() for _, dst in ready)
+        pending = [pair for pair in pending if pair not in ready]
+    return ordered
+
+
+def create_db_clones(
+    pairs: list[tuple[str, str]],
+    usage: tuple[str] = (),
+    max_concurrency: int = MAX_CONCURRENCY,
+    max_parallel: int = 4,
+) -> bool:
+    """Clone many databases in parallel, at most max_parallel at a time.
+
+    The follow up statements of each database start as soon as its clone is
+    done. A database cloned from another clone waits for that clone. Returns
+    False if anything failed.
+    """
+    pairs = _clone_order(pairs)
+    ctx = session.get_connection()
+    futures = {}
+    results = {}
+
+    def clone(src, dst):
+        dependency = futures.get(src.lower())
+        if dependency is not None and not dependency.result():
+            print(f"{dst}: skipped, cloning {src} failed")
+            return False
+        started = time.monotonic()
+        try:
+            results[dst] = _clone_database(
+                ctx=ctx, src=src, dst=dst, usage=usage, max_concurrency=max_concurrency
+            )
+        except (ValueError, Error) as e:
+            print(f"{dst}: failed, {e}")
+            return False
+        failed = sum(1 for result in results[dst] if result["error"])
+        status = f"{failed} statements failed" if failed else "done"
+        print(
+            f"{dst}: cloned from {src}, {status} in {time.monotonic() - started:.2f}s"
+        )
+        return not failed
+
+    with alive_bar(len(pairs), title="Cloning databases") as bar:
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            # Submitted in clone order, so a clone is always started before the
+            # clones waiting for it
+            for src, dst in pairs:
+                futures[dst.lower()] = executor.submit(clone, src, dst)
+            for future in as_completed(futures.values()):
+                future.result()
+                bar()
+
+    for src, dst in pairs:
+        if dst in results:
+            print(f"\n{src} -> {dst}")
+            _print_statement_report(results[dst])
+    return all(future.result() for future in futures.values())
+
+
+def _run_concurrently(
+    ctx, statements: list[str], max_concurrency: int = MAX_CONCURRENCY
+) -> list[dict]:
+    """Run the statements with execute_async, at most max_concurrency at a time.
+
+    Returns the statement, its duration in seconds and its error, if any, for
+    every statement in the order given.
+    """
+    cur = ctx.cursor()
+    results = [
+        {"statement": statement, "seconds": None, "error": None}
+        for statement in statements
+    ]
+    pending = list(reversed(results))
+    running = {}
+    poll_interval = POLL_INTERVAL
+    while pending or running:
+        while pending and len(running) < max_concurrency:
+            result = pending.pop()
+            started = time.monotonic()
+            try:
+                cur.execute_async(result["statement"])
+            except Error as e:
+                result["seconds"] = time.monotonic() - started
+                result["error"] = str(e)
+                continue
+            running[cur.sfqid] = (result, started)
+        for query_id, (result, started) in list(running.items()):
+            try:
+                status = ctx.get_query_status_throw_if_error(query_id)
+                if ctx.is_still_running(status):
+                    continue
+            except Error as e:
+                result["error"] = str(e)
+            result["seconds"] = time.monotonic() - started
+            del running[query_id]
+            poll_interval = POLL_INTERVAL
+        if running:
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+    return results
+
+
+def _print_statement_report(results: list[dict]):
+    if not results:
+        return
+    for result in results:
+        status = f"FAILED: {result['error']}" if result["error"] else "ok"
+        print(f"{result['seconds']:7.2f}s  {result['statement']}  {status}")
+    failed = sum(1 for result in results if result["error"])
+    total = sum(result["seconds"] for result in results)
+    print(
+        f"{len(results) - failed} of {len(results)} statements succeeded, {total:.2f}s in total"
+    )
 
 
 def _suspend_dynamic_tables(db, dynamic_tables: list[dict]) -> list[str]:
@@ -1,42 +1,221 @@
-import os
-from typing import Optional
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Sequence
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import snowflake.connector
+from alive_progress import alive_bar
 from snowflake.connector import DictCursor
+from snowflake.connector.cursor import SnowflakeCursor
 
+from vdc import session
+from vdc.report import open_report
 from vdc.utils import _spinner
 
 
-# Snowflake-config
-def _snow_config():
-    return {
-        "user": os.environ["DBT_USR"],
-        "authenticator": "externalbrowser",
-        "account": "wx23413.europe-west4.gcp",
-        "role": "sysadmin",
-        "warehouse": "dev__xs",
-    }
+def _key_columns(primary_key) -> list[str]:
+    """Primary key as a list of columns, also for a single key column"""
+    if isinstance(primary_key, str):
+        return [primary_key]
+    return list(primary_key)
+
+
+def _execute_async(ctx, queries: list[str]) -> list[str]:
+    """Submit the queries to run concurrently in the session and return their ids"""
+    cur = ctx.cursor()
+    query_ids = []
+    for query in queries:
+        cur.execute_async(query)
+        query_ids.append(cur.sfqid)
+    return query_ids
+
 
+def _async_result(ctx, query_id: str, cursor_class=SnowflakeCursor):
+    """Cursor over the result of a submitted query, waiting for it to finish"""
+    cur = ctx.cursor(cursor_class)
+    cur.get_results_from_sfqid(query_id)
+    return cur
 
-def _fetch_diff(prod_query, dev_query):
+
+def _fetch_typed_df(cur) -> pd.DataFrame:
+    """Fetch the result as a DataFrame with Arrow backed native dtypes"""
+    table = cur.fetch_arrow_all()
+    if table is None:
+        return pd.DataFrame(columns=[column.name for column in cur.description])
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _fetch_diff(ctx, prod_query, dev_query, typed=False):
+    fetch = _fetch_typed_df if typed else lambda cur: cur.fetch_pandas_all()
     with _spinner("Fetching data"):
-        with snowflake.connector.connect(**_snow_config()) as ctx:
-            cur = ctx.cursor()
-            cur.execute(prod_query)
-            prod_df = cur.fetch_pandas_all()
+        prod_id, dev_id = _execute_async(ctx, [prod_query, dev_query])
+        prod_df = fetch(_async_result(ctx, prod_id))
+        dev_df = fetch(_async_result(ctx, dev_id))
+        return prod_df, dev_df
+
 
-            cur.execute(dev_query)
-            dev_df = cur.fetch_pandas_all()
-            return prod_df, dev_df
+def _partition_ids(keys: pa.Table, partitions: int):
+    """Partition of each row, hashed from the key as text so the same key lands
+    in the same partition whatever its Arrow type is on each side"""
+    keys = pd.DataFrame(
+        {
+            name: keys.column(name).cast(pa.string()).to_pandas()
+            for name in keys.column_names
+        }
+    )
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy() % partitions
 
 
-def _query_builder(
-    table: str,
-    compare_to: str,
+def _widened_schema(schema: pa.Schema) -> pa.Schema:
+    """Snowflake narrows numbers to the smallest type that fits each result
+    chunk, e.g. int8 for one chunk and int16 for the next. Widen them so every
+    chunk of the result can be cast to the schema"""
+    fields = []
+    for field in schema:
+        if pa.types.is_integer(field.type):
+            field = field.with_type(pa.int64())
+        elif pa.types.is_floating(field.type):
+            field = field.with_type(pa.float64())
+        elif pa.types.is_decimal(field.type):
+            field = field.with_type(pa.decimal128(38, field.type.scale))
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def _spill_batches(
+    batches: Iterable[pa.Table], directory: Path, primary_key, partitions: int
+) -> int:
+    """Write arrow batches to one Arrow IPC file per primary key hash partition"""
+    directory.mkdir(parents=True, exist_ok=True)
+    writers = {}
+    schema = None
+    rows = 0
+    try:
+        for batch in batches:
+            schema = schema or _widened_schema(batch.schema)
+            batch = batch.cast(schema)
+            partition_ids = _partition_ids(
+                batch.select(_key_columns(primary_key)), partitions
+            )
+            for partition in set(partition_ids.tolist()):
+                part = batch.filter(pa.array(partition_ids == partition))
+                writer = writers.get(partition)
+                if writer is None:
+                    writer = pa.ipc.new_file(
+                        str(directory / f"{partition}.arrow"), schema
+                    )
+                    writers[partition] = writer
+                writer.write_table(part)
+            rows += batch.num_rows
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return rows
+
+
+def _read_partition(
+    directory: Path, partition: int, typed=False
+) -> Optional[pd.DataFrame]:
+    path = directory / f"{partition}.arrow"
+    if not path.exists():
+        return None
+    table = pa.ipc.open_file(str(path)).read_all()
+    if typed:
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+    return table.to_pandas()
+
+
+def _fetch_diff_to_partitions(
+    ctx, prod_query, dev_query, directory: Path, primary_key, partitions: int
+) -> tuple[int, int]:
+    with _spinner("Fetching data"):
+        prod_id, dev_id = _execute_async(ctx, [prod_query, dev_query])
+        prod_rows = _spill_batches(
+            batches=_async_result(ctx, prod_id).fetch_arrow_batches(),
+            directory=directory / "prod",
+            primary_key=primary_key,
+            partitions=partitions,
+        )
+        dev_rows = _spill_batches(
+            batches=_async_result(ctx, dev_id).fetch_arrow_batches(),
+            directory=directory / "dev",
+            primary_key=primary_key,
+            partitions=partitions,
+        )
+        return prod_rows, dev_rows
+
+
+def _compare_partitions(
+    directory: Path,
+    prod_name,
+    dev_name,
+    primary_key,
+    partitions: int,
+    typed=False,
+) -> Iterator[pd.DataFrame]:
+    """Compare the spilled diff partition by partition"""
+    for partition in range(partitions):
+        prod_df = _read_partition(directory / "prod", partition, typed=typed)
+        dev_df = _read_partition(directory / "dev", partition, typed=typed)
+        if prod_df is None and dev_df is None:
+            continue
+        if prod_df is None:
+            prod_df = pd.DataFrame(columns=dev_df.columns)
+        if dev_df is None:
+            dev_df = pd.DataFrame(columns=prod_df.columns)
+        diff = _compare_df(
+            prod_df=prod_df,
+            dev_df=dev_df,
+            prod_name=prod_name,
+            dev_name=dev_name,
+            primary_key=primary_key,
+        )
+        if not diff.empty:
+            yield diff
+
+
+def _fetch_join_diff(ctx, query):
+    with _spinner("Fetching data"):
+        cur = ctx.cursor()
+        cur.execute(query)
+        return cur.fetch_pandas_all()
+
+
+def _fetch_fingerprint(ctx, query) -> dict:
+    with _spinner("Fingerprinting tables"):
+        cur = ctx.cursor(DictCursor)
+        cur.execute(query)
+        return {row["SIDE"]: row for row in cur.fetchall()}
+
+
+def _fetch_row_count(ctx, table, where=None) -> int:
+    where = f" where {where}" if where else ""
+    cur = ctx.cursor()
+    cur.execute(f"select count(*) from {table}{where}")
+    return cur.fetchone()[0]
+
+
+def _fetch_buckets(ctx, query) -> list[dict]:
+    with _spinner("Comparing buckets"):
+        cur = ctx.cursor(DictCursor)
+        cur.execute(query)
+        return cur.fetchall()
+
+
+def _fetch_summary(ctx, query) -> tuple:
+    with _spinner("Summarizing differences"):
+        cur = ctx.cursor()
+        cur.execute(query)
+        return cur.fetchone()
+
+
+def _compare_columns(
     columns: Optional[tuple],
     ignore_columns: Optional[tuple],
-    primary_key: str,
+    primary_key: Sequence[str],
     table_desc: list[dict],
     compare_to_desc: list[dict],
 ) -> list[str]:
@@ -45,41 +224,419 @@ def _query_builder(
     unique_columns = table_column.intersection(compare_to_column)
     if columns:
         columns = tuple(c.lower() for c in columns)
-        unique_columns = set(columns + (primary_key.lower(),))
+        unique_columns = set(
+            columns + tuple(k.lower() for k in _key_columns(primary_key))
+        )
 
     if ignore_columns:
         ignore_columns = tuple(c.lower() for c in ignore_columns)
         unique_columns = unique_columns - set(ignore_columns)
 
-    cols = ",\n".join(f"{col}::varchar as {col}" for col in unique_columns)
+    return sorted(unique_columns)
+
+
+def _column_types(desc: list[dict]) -> dict[str, str]:
+    """Base data type per column, e.g. NUMBER for NUMBER(38,0)"""
+    return {t["name"].lower(): t["type"].split("(")[0].upper() for t in desc}
+
+
+def _select_expression(
+    column: str, table_types: dict[str, str], compare_to_types: dict[str, str]
+) -> str:
+    """Select the column natively when both tables agree on the type"""
+    if table_types.get(column) == compare_to_types.get(column):
+        return f"{column}"
+    return f"{column}::varchar as {column}"
+
+
+def _query_builder(
+    table: str,
+    compare_to: str,
+    columns: Optional[tuple],
+    ignore_columns: Optional[tuple],
+    primary_key: Sequence[str],
+    table_desc: list[dict],
+    compare_to_desc: list[dict],
+    where: Optional[str] = None,
+    typed: bool = False,
+) -> list[str]:
+    unique_columns = _compare_columns(
+        columns=columns,
+        ignore_columns=ignore_columns,
+        primary_key=primary_key,
+        table_desc=table_desc,
+        compare_to_desc=compare_to_desc,
+    )
+
+    if typed:
+        table_types = _column_types(table_desc)
+        compare_to_types = _column_types(compare_to_desc)
+        cols = ",\n".join(
+            _select_expression(col, table_types, compare_to_types)
+            for col in unique_columns
+        )
+    else:
+        cols = ",\n".join(f"{col}::varchar as {col}" for col in unique_columns)
+    where = f"\nwhere {where}" if where else ""
     return [
-        f"select\n{cols}\nfrom {table}\nexcept\nselect\n{cols}\nfrom {compare_to}",
-        f"select\n{cols}\nfrom {compare_to}\nexcept\nselect\n{cols}\nfrom {table}",
+        f"select\n{cols}\nfrom {table}{where}\nexcept\nselect\n{cols}\nfrom {compare_to}{where}",
+        f"select\n{cols}\nfrom {compare_to}{where}\nexcept\nselect\n{cols}\nfrom {table}{where}",
     ]
 
 
+def _fingerprint_query_builder(
+    table: str,
+    compare_to: str,
+    columns: Optional[tuple],
+    ignore_columns: Optional[tuple],
+    primary_key: Sequence[str],
+    table_desc: list[dict],
+    compare_to_desc: list[dict],
+    where: Optional[str] = None,
+) -> str:
+    """Row count and order independent HASH_AGG of the compared columns.
+
+    The columns are hashed in their native types, so a matching fingerprint
+    means the tables are equal also after the varchar cast in the row diff.
+    """
+    unique_columns = _compare_columns(
+        columns=columns,
+        ignore_columns=ignore_columns,
+        primary_key=primary_key,
+        table_desc=table_desc,
+        compare_to_desc=compare_to_desc,
+    )
+    cols = ", ".join(unique_columns)
+    where = f"\nwhere {where}" if where else ""
+    return (
+        f"select 'table' as side, count(*) as row_count, hash_agg({cols}) as fingerprint\n"
+        f"from {table}{where}\n"
+        "union all\n"
+        f"select 'compare_to' as side, count(*) as row_count, hash_agg({cols}) as fingerprint\n"
+        f"from {compare_to}{where}"
+    )
+
+
+def _bucket_expression(primary_key: Sequence[str], modulus: int) -> str:
+    keys = ", ".join(f"{k.lower()}::varchar" for k in _key_columns(primary_key))
+    return f"mod(abs(hash({keys})), {modulus})"
+
+
+def _sample_predicate(primary_key: Sequence[str], percent: float) -> str:
+    """Deterministic sample of the keys, picking the same keys in both tables.
+
+    The sample is at least one in a million keys, so a tiny percentage still
+    compares some rows instead of none.
+    """
+    threshold = max(1, round(percent * 10000))
+    return f"{_bucket_expression(primary_key, 1000000)} < {threshold}"
+
+
+def _and_predicates(*predicates: Optional[str]) -> Optional[str]:
+    predicates = [f"({predicate})" for predicate in predicates if predicate]
+    return " and ".join(predicates) or None
+
+
+def _bucket_predicate(buckets: dict[int, list[int]], primary_key: Sequence[str]) -> str:
+    """Predicate matching the rows in the given buckets, grouped by modulus"""
+    return " or ".join(
+        f"{_bucket_expression(primary_key, modulus)} in ({', '.join(map(str, sorted(bucket_ids)))})"
+        for modulus, bucket_ids in sorted(buckets.items())
+    )
+
+
+def _bucket_query_builder(
+    table: str,
+    compare_to: str,
+    columns: Optional[tuple],
+    ignore_columns: Optional[tuple],
+    primary_key: Sequence[str],
+    table_desc: list[dict],
+    compare_to_desc: list[dict],
+    modulus: int,
+    where: Optional[str] = None,
+) -> str:
+    """Row count and HASH_AGG per primary key hash bucket for both tables"""
+    unique_columns = _compare_columns(
+        columns=columns,
+        ignore_columns=ignore_columns,
+        primary_key=primary_key,
+        table_desc=table_desc,
+        compare_to_desc=compare_to_desc,
+    )
+    cols = ", ".join(unique_columns)
+    bucket = _bucket_expression(primary_key, modulus)
+    where = f"\nwhere {where}" if where else ""
+    return "\nunion all\n".join(
+        f"select '{side}' as side, {bucket} as bucket, "
+        f"count(*) as row_count, hash_agg({cols}) as fingerprint\n"
+        f"from {name}{where}\n"
+        "group by bucket"
+        for side, name in (("table", table), ("compare_to", compare_to))
+    )
+
+
+def _mismatched_buckets(rows: list[dict]) -> dict[int, tuple[int, int]]:
+    """Buckets where row count or fingerprint differ, with the row count per side"""
+    buckets = {}
+    for row in rows:
+        buckets.setdefault(row["BUCKET"], {})[row["SIDE"]] = row
+    empty = {"ROW_COUNT": 0, "FINGERPRINT": None}
+    mismatched = {}
+    for bucket, sides in buckets.items():
+        table_bucket = sides.get("table", empty)
+        compare_to_bucket = sides.get("compare_to", empty)
+        if (
+            table_bucket["ROW_COUNT"] != compare_to_bucket["ROW_COUNT"]
+            or table_bucket["FINGERPRINT"] != compare_to_bucket["FINGERPRINT"]
+        ):
+            mismatched[bucket] = (
+                table_bucket["ROW_COUNT"],
+                compare_to_bucket["ROW_COUNT"],
+            )
+    return mismatched
+
+
+def _join_diff_query_builder(
+    table: str,
+    compare_to: str,
+    columns: Optional[tuple],
+    ignore_columns: Optional[tuple],
+    primary_key: Sequence[str],
+    table_desc: list[dict],
+    compare_to_desc: list[dict],
+    where: Optional[str] = None,
+) -> str:
+    """Full outer join on the primary key and unpivot the differing cells.
+
+    Only one row per differing cell, (*pk, column_name, left_value, right_value),
+    is returned from Snowflake. A row missing in one of the tables shows up as
+    differences in every non-null column, including the primary key.
+    """
+    unique_columns = _compare_columns(
+        columns=columns,
+        ignore_columns=ignore_columns,
+        primary_key=primary_key,
+        table_desc=table_desc,
+        compare_to_desc=compare_to_desc,
+    )
+    keys = [k.lower() for k in _key_columns(primary_key)]
+    if where:
+        table = f"(select * from {table} where {where})"
+        compare_to = f"(select * from {compare_to} where {where})"
+
+    cells = ",\n".join(
+        f"iff(equal_null(a.{col}::varchar, b.{col}::varchar), null, "
+        f"object_construct_keep_null('column_name', '{col}', "
+        f"'left_value', a.{col}::varchar, 'right_value', b.{col}::varchar))"
+        for col in unique_columns
+    )
+    return (
+        "select\n"
+        f"{', '.join(keys)},\n"
+        "d.value:column_name::varchar as column_name,\n"
+        "d.value:left_value::varchar as left_value,\n"
+        "d.value:right_value::varchar as right_value\n"
+        "from (\n"
+        "select\n"
+        + "".join(f"coalesce(a.{k}, b.{k})::varchar as {k},\n" for k in keys)
+        + f"array_construct_compact(\n{cells}\n) as diffs\n"
+        f"from {table} a\nfull outer join {compare_to} b on "
+        + " and ".join(f"a.{k} = b.{k}" for k in keys)
+        + "\n"
+        "),\n"
+        "lateral flatten(input => diffs) d"
+    )
+
+
+NUMERIC_TYPES = {
+    "NUMBER",
+    "DECIMAL",
+    "NUMERIC",
+    "INT",
+    "INTEGER",
+    "BIGINT",
+    "SMALLINT",
+    "TINYINT",
+    "BYTEINT",
+    "FLOAT",
+    "FLOAT4",
+    "FLOAT8",
+    "DOUBLE",
+    "DOUBLE PRECISION",
+    "REAL",
+}
+
+SUMMARY_METRICS = ["mismatches", "null_mismatches", "min_delta", "max_delta"]
+
+
+def _summary_query_builder(
+    table: str,
+    compare_to: str,
+    columns: Optional[tuple],
+    ignore_columns: Optional[tuple],
+    primary_key: Sequence[str],
+    table_desc: list[dict],
+    compare_to_desc: list[dict],
+    where: Optional[str] = None,
+) -> tuple[str, list[tuple[str, str]]]:
+    """Aggregate the differences per column over a full outer join.
+
+    Returns the query and the (column, metric) each selected value belongs to,
+    after the two leading counts of rows only found in one of the tables.
+    Values are compared for rows found in both tables, and the min and max
+    delta (compare_to - table) is only computed for numeric columns.
+    """
+    unique_columns = _compare_columns(
+        columns=columns,
+        ignore_columns=ignore_columns,
+        primary_key=primary_key,
+        table_desc=table_desc,
+        compare_to_desc=compare_to_desc,
+    )
+    keys = [k.lower() for k in _key_columns(primary_key)]
+    table_types = _column_types(table_desc)
+    compare_to_types = _column_types(compare_to_desc)
+    if where:
+        table = f"(select * from {table} where {where})"
+        compare_to = f"(select * from {compare_to} where {where})"
+
+    matched = f"a.{keys[0]} is not null and b.{keys[0]} is not null"
+    aggregates = [
+        f"count_if(b.{keys[0]} is null)",
+        f"count_if(a.{keys[0]} is null)",
+    ]
+    metrics = []
+    for col in unique_columns:
+        if col in keys:
+            continue
+        aggregates.append(
+            f"count_if({matched} and not equal_null(a.{col}::varchar, b.{col}::varchar))"
+        )
+        aggregates.append(
+            f"count_if({matched} and (a.{col} is null) <> (b.{col} is null))"
+        )
+        metrics += [(col, "mismatches"), (col, "null_mismatches")]
+        if (
+            table_types.get(col) in NUMERIC_TYPES
+            and compare_to_types.get(col) in NUMERIC_TYPES
+        ):
+            aggregates.append(f"min(b.{col} - a.{col})")
+            aggregates.append(f"max(b.{col} - a.{col})")
+            metrics += [(col, "min_delta"), (col, "max_delta")]
+
+    join = " and ".join(f"a.{k} = b.{k}" for k in keys)
+    query = (
+        "select\n"
+        + ",\n".join(aggregates)
+        + f"\nfrom {table} a\nfull outer join {compare_to} b on {join}"
+    )
+    return query, metrics
+
+
+def _summary_df(values: tuple, metrics: list[tuple[str, str]]) -> pd.DataFrame:
+    """One row per column with the summary metrics, most mismatches first"""
+    summary = {}
+    for (column, metric), value in zip(metrics, values):
+        summary.setdefault(column, {})[metric] = value
+    summary = pd.DataFrame.from_dict(
+        summary, orient="index", columns=SUMMARY_METRICS
+    ).rename_axis("column")
+    return summary.sort_values("mismatches", ascending=False, kind="stable")
+
+
+def _masked(values: pd.Series, mask, upcast: bool) -> pd.Series:
+    """Blank out equal cells, with the dtype DataFrame.where would have given"""
+    result = values.where(mask)
+    if upcast and isinstance(result.dtype, np.dtype) and result.dtype.kind in "iub":
+        result = result.astype("float64" if result.dtype.kind in "iu" else object)
+    return result
+
+
 def _compare_df(prod_df, dev_df, prod_name, dev_name, primary_key):
+    """Outer join both frames on the primary key and keep the differing cells.
+
+    The result has the same layout as DataFrame.compare(align_axis=0): one row
+    per table for every key with a difference, and only the differing columns.
+    """
     prod_df = prod_df.set_index(primary_key)
     dev_df = dev_df.set_index(primary_key)
 
-    prod_diff = prod_df.index.difference(dev_df.index)
-    dev_diff = dev_df.index.difference(prod_df.index)
+    keys = prod_df.index.union(dev_df.index)
+    if not keys.is_monotonic_increasing:
+        keys = keys.sort_values()
+    prod_df = prod_df.reindex(keys)
+    dev_df = dev_df.reindex(keys)
 
-    df1 = prod_df.reindex(
-        prod_df.index.values.tolist() + dev_diff.values.tolist()
-    ).sort_index()
-    df2 = dev_df.reindex(
-        dev_df.index.values.tolist() + prod_diff.values.tolist()
-    ).sort_index()
+    masks = {}
+    for column in prod_df.columns:
+        prod_values = prod_df[column]
+        dev_values = dev_df[column]
+        mask = ~((prod_values == dev_values) | (prod_values.isna() & dev_values.isna()))
+        mask = mask.fillna(True).to_numpy(dtype=bool)
+        if mask.any():
+            masks[column] = mask
 
-    return df1.compare(other=df2, align_axis=0, result_names=(prod_name, dev_name))
+    rows = (
+        np.logical_or.reduce(list(masks.values()))
+        if masks
+        else np.zeros(len(keys), dtype=bool)
+    )
+    row_count = int(rows.sum())
+    # Interleave the two tables: row i of prod followed by row i of dev
+    order = np.arange(2 * row_count).reshape(2, row_count).T.ravel()
 
+    diff = {}
+    for column, mask in masks.items():
+        upcast = not mask.all()
+        prod_values = _masked(prod_df[column], mask, upcast)[rows]
+        dev_values = _masked(dev_df[column], mask, upcast)[rows]
+        diff[column] = pd.concat([prod_values, dev_values], ignore_index=True).take(
+            order
+        )
 
-def _desc(table: str) -> list[dict]:
-    with snowflake.connector.connect(**_snow_config()) as ctx:
-        cur = ctx.cursor(DictCursor)
-        cur.execute(f"desc table {table}")
-        return cur.fetchall()
+    index = pd.MultiIndex.from_arrays(
+        [
+            *(
+                keys.get_level_values(level)[rows].repeat(2)
+                for level in range(keys.nlevels)
+            ),
+            np.tile(np.array([prod_name, dev_name], dtype=object), row_count),
+        ],
+        names=[*keys.names, None],
+    )
+    return pd.DataFrame(
+        {column: values.array for column, values in diff.items()},
+        index=index,
+        columns=list(masks),
+    )
+
+
+def _desc(ctx, tables: list[str]) -> list[list[dict]]:
+    """desc of each table, queried concurrently.
+
+    Not cached, as the tables are typically rebuilt by dbt between diffs and
+    the diff queries must use their current columns.
+    """
+    unique_tables = list(dict.fromkeys(tables))
+    query_ids = _execute_async(ctx, [f"desc table {table}" for table in unique_tables])
+    descs = {
+        table: _async_result(ctx, query_id, DictCursor).fetchall()
+        for table, query_id in zip(unique_tables, query_ids)
+    }
+    return [descs[table] for table in tables]
+
+
+def _parse_primary_key(primary_key: Optional[str]) -> list[str]:
+    """Comma separated key columns, upper cased as returned by Snowflake"""
+    return [k.strip().upper() for k in (primary_key or "").split(",") if k.strip()]
+
+
+def _declared_primary_key(ctx, table: str) -> list[str]:
+    cur = ctx.cursor(DictCursor)
+    cur.execute(f"show primary keys in table {table}")
+    keys = sorted(cur.fetchall(), key=lambda key: key["key_sequence"])
+    return [key["column_name"].upper() for key in keys]
 
 
 # Ikke lenger nødvendig nå som alt blir konvertert til string, men kan være
@@ -94,14 +651,18 @@ def _remove_tz_from_timestamp_in_df(
     return df
 
 
-def table_diff(table, primary_key, compare_to, columns, ignore_columns):
-    primary_key = primary_key.upper()
-
-    pd.set_option("display.max_rows", None)  # Set to None to display all rows
-    pd.set_option("display.max_columns", None)  # Set to None to display all columns
-    table_desc = _desc(table=table)
-    compare_to_desc = _desc(table=compare_to)
-    prod_query, dev_query = _query_builder(
+def _server_side_diff(
+    ctx,
+    table,
+    primary_key,
+    compare_to,
+    columns,
+    ignore_columns,
+    table_desc,
+    compare_to_desc,
+    where=None,
+):
+    query = _join_diff_query_builder(
         table=table,
         compare_to=compare_to,
         columns=columns,
@@ -109,37 +670,611 @@ def table_diff(table, primary_key, compare_to, columns, ignore_columns):
         primary_key=primary_key,
         table_desc=table_desc,
         compare_to_desc=compare_to_desc,
+        where=where,
     )
+    diff = _fetch_join_diff(ctx=ctx, query=query)
+    diff = diff.rename(
+        columns={
+            "COLUMN_NAME": "column",
+            "LEFT_VALUE": table,
+            "RIGHT_VALUE": compare_to,
+        }
+    )
+    return diff.set_index([*_key_columns(primary_key), "column"]).sort_index()
+
+
+def _locate_diff_buckets(
+    ctx,
+    table,
+    primary_key,
+    compare_to,
+    columns,
+    ignore_columns,
+    table_desc,
+    compare_to_desc,
+    buckets: int,
+    bucket_rows: int,
+    where: Optional[str] = None,
+    max_depth: int = 6,
+) -> dict[int, dict[int, tuple[int, int]]]:
+    """Recursively narrow down the hash buckets that contain differences.
+
+    Each level splits the mismatching buckets into `buckets` sub buckets by
+    multiplying the modulus, and stops once a bucket has at most `bucket_rows`
+    rows on each side. Returns the located buckets grouped by modulus.
+    """
+    located = {}
+    modulus = buckets
+    scope = where
+    for depth in range(max_depth):
+        query = _bucket_query_builder(
+            table=table,
+            compare_to=compare_to,
+            columns=columns,
+            ignore_columns=ignore_columns,
+            primary_key=primary_key,
+            table_desc=table_desc,
+            compare_to_desc=compare_to_desc,
+            modulus=modulus,
+            where=where,
+        )
+        mismatched = _mismatched_buckets(_fetch_buckets(ctx=ctx, query=query))
+        too_large = {
+            bucket: rows
+            for bucket, rows in mismatched.items()
+            if max(rows) > bucket_rows
+        }
+        small_enough = {
+            bucket: rows
+            for bucket, rows in mismatched.items()
+            if bucket not in too_large
+        }
+        if small_enough:
+            located[modulus] = small_enough
+        if not too_large:
+            break
+        if depth == max_depth - 1:
+            located[modulus] = mismatched
+            break
+        where = _and_predicates(
+            scope, _bucket_predicate({modulus: list(too_large)}, primary_key)
+        )
+        modulus *= buckets
+    return located
 
-    prod_df, dev_df = _fetch_diff(prod_query=prod_query, dev_query=dev_query)
 
-    print("\nRows different or missing in other table:")
-    print(f"{table}:".ljust(45) + f"{len(prod_df)}".rjust(10) + " rows")
-    print(f"{compare_to}:".ljust(45) + f"{len(dev_df)}".rjust(10) + " rows")
+def _bucketed_diff(
+    ctx,
+    table,
+    primary_key,
+    compare_to,
+    columns,
+    ignore_columns,
+    table_desc,
+    compare_to_desc,
+    buckets,
+    bucket_rows,
+    where=None,
+):
+    located = _locate_diff_buckets(
+        ctx=ctx,
+        table=table,
+        primary_key=primary_key,
+        compare_to=compare_to,
+        columns=columns,
+        ignore_columns=ignore_columns,
+        table_desc=table_desc,
+        compare_to_desc=compare_to_desc,
+        buckets=buckets,
+        bucket_rows=bucket_rows,
+        where=where,
+    )
+
+    print("\nBuckets with differences:")
+    print("Bucket".ljust(25) + f"{table}".rjust(45) + f"{compare_to}".rjust(45))
+    for modulus, mismatched in sorted(located.items()):
+        for bucket, (table_rows, compare_to_rows) in sorted(mismatched.items()):
+            print(
+                f"{bucket} mod {modulus}".ljust(25)
+                + f"{table_rows}".rjust(45)
+                + f"{compare_to_rows}".rjust(45)
+            )
     print("")
 
-    if len(prod_df) == 0 and len(dev_df) == 0:
-        print("No diff")
-        return
+    if not located:
+        return None
+    return _bucket_predicate(
+        {modulus: list(mismatched) for modulus, mismatched in located.items()},
+        primary_key,
+    )
+
+
+def _summary_diff(
+    ctx,
+    table,
+    primary_key,
+    compare_to,
+    columns,
+    ignore_columns,
+    table_desc,
+    compare_to_desc,
+    where=None,
+):
+    query, metrics = _summary_query_builder(
+        table=table,
+        compare_to=compare_to,
+        columns=columns,
+        ignore_columns=ignore_columns,
+        primary_key=primary_key,
+        table_desc=table_desc,
+        compare_to_desc=compare_to_desc,
+        where=where,
+    )
+    only_in_table, only_in_compare_to, *values = _fetch_summary(ctx=ctx, query=query)
+
+    print("\nRows missing in other table:")
+    print(f"{table}:".ljust(45) + f"{only_in_table}".rjust(10) + " rows")
+    print(f"{compare_to}:".ljust(45) + f"{only_in_compare_to}".rjust(10) + " rows")
+    print("")
+    print("Differences per column in rows found in both tables:")
+    print(_summary_df(values=values, metrics=metrics).to_string())
+    print("")
 
-    diff = _compare_df(
-        prod_df=prod_df,
-        dev_df=dev_df,
-        prod_name=table,
-        dev_name=compare_to,
+
+def _fingerprints_match(
+    ctx,
+    table,
+    primary_key,
+    compare_to,
+    columns,
+    ignore_columns,
+    table_desc,
+    compare_to_desc,
+    where=None,
+) -> bool:
+    query = _fingerprint_query_builder(
+        table=table,
+        compare_to=compare_to,
+        columns=columns,
+        ignore_columns=ignore_columns,
         primary_key=primary_key,
+        table_desc=table_desc,
+        compare_to_desc=compare_to_desc,
+        where=where,
     )
+    fingerprints = _fetch_fingerprint(ctx=ctx, query=query)
+    table_fingerprint = fingerprints["table"]
+    compare_to_fingerprint = fingerprints["compare_to"]
+
+    print("\nFingerprint:")
+    for name, fingerprint in (
+        (table, table_fingerprint),
+        (compare_to, compare_to_fingerprint),
+    ):
+        print(
+            f"{name}:".ljust(45)
+            + f"{fingerprint['ROW_COUNT']}".rjust(10)
+            + " rows  "
+            + f"{fingerprint['FINGERPRINT']}"
+        )
+    print("")
+
+    return (
+        table_fingerprint["ROW_COUNT"] == compare_to_fingerprint["ROW_COUNT"]
+        and table_fingerprint["FINGERPRINT"] == compare_to_fingerprint["FINGERPRINT"]
+    )
+
+
+def table_diff(
+    table,
+    primary_key,
+    compare_to,
+    columns,
+    ignore_columns,
+    server_side=False,
+    fingerprint=True,
+    bucketed=False,
+    buckets=16,
+    bucket_rows=10000,
+    stream=False,
+    partitions=64,
+    typed=False,
+    where=None,
+    sample=None,
+    sample_rows=None,
+    summary=False,
+    output=None,
+):
+    primary_key = _parse_primary_key(primary_key)
+
+    pd.set_option("display.max_rows", None)  # Set to None to display all rows
+    pd.set_option("display.max_columns", None)  # Set to None to display all columns
+    with session.connection() as ctx:
+        if not primary_key:
+            primary_key = _declared_primary_key(ctx=ctx, table=table)
+            if not primary_key:
+                print(
+                    f"No primary key provided and no primary key constraint found on {table}"
+                )
+                return
+            print(f"Using primary key constraint: {', '.join(primary_key)}")
+
+        with _spinner("Describing tables"):
+            table_desc, compare_to_desc = _desc(ctx=ctx, tables=[table, compare_to])
+
+        if sample_rows:
+            row_count = _fetch_row_count(ctx=ctx, table=table, where=where)
+            sample = min(100.0, 100.0 * sample_rows / max(row_count, 1))
+        if sample:
+            print(f"Sampling {sample:.4g}% of the primary keys")
+            where = _and_predicates(where, _sample_predicate(primary_key, sample))
+
+        if fingerprint and _fingerprints_match(
+            ctx=ctx,
+            table=table,
+            primary_key=primary_key,
+            compare_to=compare_to,
+            columns=columns,
+            ignore_columns=ignore_columns,
+            table_desc=table_desc,
+            compare_to_desc=compare_to_desc,
+            where=where,
+        ):
+            print("No diff")
+            return
+
+        if summary:
+            _summary_diff(
+                ctx=ctx,
+                table=table,
+                primary_key=primary_key,
+                compare_to=compare_to,
+                columns=columns,
+                ignore_columns=ignore_columns,
+                table_desc=table_desc,
+                compare_to_desc=compare_to_desc,
+                where=where,
+            )
+            return
+
+        if server_side:
+            diff = _server_side_diff(
+                ctx=ctx,
+                table=table,
+                primary_key=primary_key,
+                compare_to=compare_to,
+                columns=columns,
+                ignore_columns=ignore_columns,
+                table_desc=table_desc,
+                compare_to_desc=compare_to_desc,
+                where=where,
+            )
+            rows = diff.index.droplevel("column").nunique()
+            print("\nDifferences computed in Snowflake:")
+            print("Rows:".ljust(45) + f"{rows}".rjust(10))
+            print("Cells:".ljust(45) + f"{len(diff)}".rjust(10))
+            print("")
+            if diff.empty:
+                print("No diff")
+                return
+            _present_diff(diffs=[diff], table=table, output=output)
+            return
+
+        if bucketed:
+            bucket_where = _bucketed_diff(
+                ctx=ctx,
+                table=table,
+                primary_key=primary_key,
+                compare_to=compare_to,
+                columns=columns,
+                ignore_columns=ignore_columns,
+                table_desc=table_desc,
+                compare_to_desc=compare_to_desc,
+                buckets=buckets,
+                bucket_rows=bucket_rows,
+                where=where,
+            )
+            if bucket_where is None:
+                print("No diff")
+                return
+            where = _and_predicates(where, bucket_where)
+
+        prod_query, dev_query = _query_builder(
+            table=table,
+            compare_to=compare_to,
+            columns=columns,
+            ignore_columns=ignore_columns,
+            primary_key=primary_key,
+            table_desc=table_desc,
+            compare_to_desc=compare_to_desc,
+            where=where,
+            typed=typed,
+        )
+
+        if stream:
+            with tempfile.TemporaryDirectory(prefix="vdc_diff_") as spill_dir:
+                spill_dir = Path(spill_dir)
+                prod_rows, dev_rows = _fetch_diff_to_partitions(
+                    ctx=ctx,
+                    prod_query=prod_query,
+                    dev_query=dev_query,
+                    directory=spill_dir,
+                    primary_key=primary_key,
+                    partitions=partitions,
+                )
+                print("\nRows different or missing in other table:")
+                print(f"{table}:".ljust(45) + f"{prod_rows}".rjust(10) + " rows")
+                print(f"{compare_to}:".ljust(45) + f"{dev_rows}".rjust(10) + " rows")
+                print("")
+
+                if prod_rows == 0 and dev_rows == 0:
+                    print("No diff")
+                    return
 
-    preview_diff = input("Preview diff? y/N:").lower() == "y"
-    if preview_diff:
-        print("Diff:")
-        print(diff)
+                diffs = _compare_partitions(
+                    directory=spill_dir,
+                    prod_name=table,
+                    dev_name=compare_to,
+                    primary_key=primary_key,
+                    partitions=partitions,
+                    typed=typed,
+                )
+                value_columns = [
+                    column.upper()
+                    for column in _compare_columns(
+                        columns=columns,
+                        ignore_columns=ignore_columns,
+                        primary_key=primary_key,
+                        table_desc=table_desc,
+                        compare_to_desc=compare_to_desc,
+                    )
+                    if column.upper() not in primary_key
+                ]
+                _present_diff(
+                    diffs=diffs, table=table, output=output, columns=value_columns
+                )
+            return
+
+        prod_df, dev_df = _fetch_diff(
+            ctx=ctx, prod_query=prod_query, dev_query=dev_query, typed=typed
+        )
+
+        print("\nRows different or missing in other table:")
+        print(f"{table}:".ljust(45) + f"{len(prod_df)}".rjust(10) + " rows")
+        print(f"{compare_to}:".ljust(45) + f"{len(dev_df)}".rjust(10) + " rows")
         print("")
 
-    generate_report = input("Export to excel? y/N:").lower() == "y"
-    if generate_report:
-        dagens_dato = pd.Timestamp.now().strftime("%Y-%m-%d")
-        file_name = f"diff_{table.lower()}_{dagens_dato}.xlsx"
-        with pd.ExcelWriter(file_name, engine="xlsxwriter") as writer:
-            diff.to_excel(writer, sheet_name="diff", merge_cells=False)
-        print(f"Excel-report stored as: {file_name}")
+        if len(prod_df) == 0 and len(dev_df) == 0:
+            print("No diff")
+            return
+
+        diff = _compare_df(
+            prod_df=prod_df,
+            dev_df=dev_df,
+            prod_name=table,
+            dev_name=compare_to,
+            primary_key=primary_key,
+        )
+        _present_diff(diffs=[diff], table=table, output=output)
+
+
+def _present_diff(
+    diffs: Iterable[pd.DataFrame],
+    table,
+    output: Optional[str] = None,
+    columns: Optional[list[str]] = None,
+):
+    """Preview and export the diff batch by batch.
+
+    With an output file the diff is written without asking, otherwise the
+    user is asked whether to preview it and whether to export it to Excel.
+    """
+    preview_diff = False
+    if not output:
+        preview_diff = input("Preview diff? y/N:").lower() == "y"
+        generate_report = input("Export to excel? y/N:").lower() == "y"
+        if generate_report:
+            dagens_dato = pd.Timestamp.now().strftime("%Y-%m-%d")
+            output = f"diff_{table.lower()}_{dagens_dato}.xlsx"
+
+    report = open_report(output, columns=columns) if output else None
+    try:
+        if preview_diff:
+            print("Diff:")
+        for diff in diffs:
+            if preview_diff:
+                print(diff)
+            if report:
+                report.write(diff)
+        if preview_diff:
+            print("")
+    finally:
+        if report:
+            report.close()
+
+    if report:
+        print(f"Report with {report.rows} rows stored as: {output}")
+
+
+def _read_tables_file(path: str) -> list[tuple[str, Optional[str]]]:
+    """Tables to diff, one db.schema.table per line, optionally followed by the
+    comma separated primary key. Empty lines and lines starting with # are skipped.
+    """
+    tables = []
+    for line in Path(path).read_text().splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        table, _, primary_key = line.partition(" ")
+        tables.append((table, primary_key.strip() or None))
+    return tables
+
+
+def _schema_tables(ctx, schemas: list[str]) -> list[set[str]]:
+    """Names of the tables and views in each of the given db.schema"""
+    queries = []
+    for schema in schemas:
+        db, schema_name = schema.split(".")
+        queries.append(
+            f"select table_name from {db}.information_schema.tables "
+            f"where table_schema = '{schema_name.upper()}' "
+            "and table_type in ('BASE TABLE', 'VIEW')"
+        )
+    return [
+        set(row[0].lower() for row in _async_result(ctx, query_id).fetchall())
+        for query_id in _execute_async(ctx, queries)
+    ]
+
+
+def _diff_counts(
+    ctx, table, compare_to, primary_key, columns, ignore_columns, where=None
+) -> dict:
+    """Fingerprint and, if they differ, count the differing rows of one table pair"""
+    result = {"table": table, "compare_to": compare_to}
+    try:
+        table_desc, compare_to_desc = _desc(ctx=ctx, tables=[table, compare_to])
+        primary_key = _parse_primary_key(primary_key)
+        if columns and not primary_key:
+            # The key is only used to add its columns to --columns, the
+            # counts compare whole rows
+            primary_key = _declared_primary_key(ctx=ctx, table=table)
+        query = _fingerprint_query_builder(
+            table=table,
+            compare_to=compare_to,
+            columns=columns,
+            ignore_columns=ignore_columns,
+            primary_key=primary_key,
+            table_desc=table_desc,
+            compare_to_desc=compare_to_desc,
+            where=where,
+        )
+        (query_id,) = _execute_async(ctx, [query])
+        fingerprints = {
+            row["SIDE"]: row
+            for row in _async_result(ctx, query_id, DictCursor).fetchall()
+        }
+        result["table_rows"] = fingerprints["table"]["ROW_COUNT"]
+        result["compare_to_rows"] = fingerprints["compare_to"]["ROW_COUNT"]
+        if (
+            result["table_rows"] == result["compare_to_rows"]
+            and fingerprints["table"]["FINGERPRINT"]
+            == fingerprints["compare_to"]["FINGERPRINT"]
+        ):
+            result["status"] = "identical"
+            return result
+
+        queries = _query_builder(
+            table=table,
+            compare_to=compare_to,
+            columns=columns,
+            ignore_columns=ignore_columns,
+            primary_key=primary_key,
+            table_desc=table_desc,
+            compare_to_desc=compare_to_desc,
+            where=where,
+        )
+        query_ids = _execute_async(
+            ctx, [f"select count(*) from (\n{query}\n)" for query in queries]
+        )
+        (
+            result["table_rows_different"],
+            result["compare_to_rows_different"],
+        ) = [_async_result(ctx, query_id).fetchone()[0] for query_id in query_ids]
+        different = (
+            result["table_rows_different"] or result["compare_to_rows_different"]
+        )
+        result["status"] = "different" if different else "identical"
+    except snowflake.connector.errors.Error as e:
+        result["status"] = f"error: {e.msg}"
+    return result
+
+
+def batch_diff(
+    tables: Optional[list[tuple[str, str, Optional[str]]]] = None,
+    schema: Optional[str] = None,
+    compare_to_schema: Optional[str] = None,
+    columns=None,
+    ignore_columns=None,
+    where=None,
+    output=None,
+    max_concurrency=4,
+    levels: Optional[list[list[tuple[str, str, Optional[str]]]]] = None,
+):
+    """Diff many table pairs over one session with a bounded number of
+    concurrent table diffs, and print one consolidated report.
+
+    Either pass (table, compare_to, primary_key) tuples in `tables`, or a
+    db.schema in `schema` to diff every table it has in common with
+    `compare_to_schema`. Tuples in `levels` are diffed one level at a time,
+    e.g. in DAG order.
+    """
+    tables = list(tables or [])
+    results = []
+    pd.set_option("display.max_rows", None)  # Set to None to display all rows
+    pd.set_option("display.max_columns", None)  # Set to None to display all columns
+    with session.connection() as ctx:
+        if schema:
+            with _spinner("Finding tables"):
+                schema_tables, compare_to_tables = _schema_tables(
+                    ctx=ctx, schemas=[schema, compare_to_schema]
+                )
+            for name in sorted(schema_tables | compare_to_tables):
+                table = f"{schema}.{name}".lower()
+                compare_to = f"{compare_to_schema}.{name}".lower()
+                if name not in compare_to_tables:
+                    results.append(
+                        {"table": table, "status": f"missing in {compare_to_schema}"}
+                    )
+                elif name not in schema_tables:
+                    results.append({"table": table, "status": f"missing in {schema}"})
+                else:
+                    tables.append((table, compare_to, None))
+
+        levels = [level for level in (levels or []) + [tables] if level]
+        with alive_bar(sum(map(len, levels)), title="Diffing tables") as bar:
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                for level in levels:
+                    futures = [
+                        executor.submit(
+                            _diff_counts,
+                            ctx=ctx,
+                            table=table,
+                            compare_to=compare_to,
+                            primary_key=primary_key,
+                            columns=columns,
+                            ignore_columns=ignore_columns,
+                            where=where,
+                        )
+                        for table, compare_to, primary_key in level
+                    ]
+                    for future in as_completed(futures):
+                        results.append(future.result())
+                        bar()
+
+    if not results:
+        print("No tables found")
+        return
+
+    report = pd.DataFrame(
+        results,
+        columns=[
+            "table",
+            "compare_to",
+            "status",
+            "table_rows",
+            "compare_to_rows",
+            "table_rows_different",
+            "compare_to_rows_different",
+        ],
+    )
+    report = report.set_index("table").sort_index()
+    print("")
+    print(report.to_string())
+    print("")
+    identical = (report["status"] == "identical").sum()
+    print(f"{identical} of {len(report)} tables are identical")
+
+    if output:
+        with open_report(output) as writer:
+            writer.write(report)
+        print(f"Report with {writer.rows} rows stored as: {output}")
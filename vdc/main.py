@@ -17,7 +17,11 @@ config = {
         "warehouse": os.getenv("SNOWFLAKE_WAREHOUSE", "dev__xs"),
         "authenticator": os.getenv("SNOWFLAKE_AUTHENTICATOR", "externalbrowser"),
         "role": os.getenv("SNOWFLAKE_ROLE", "sysadmin"),
+        # Cache the SSO token, so the browser only opens when it has expired
+        "client_store_temporary_credential": True,
     },
+    "session_pool_size": int(os.getenv("VDC_SESSION_POOL_SIZE", "1")),
+    "metadata_cache_ttl": int(os.getenv("VDC_METADATA_CACHE_TTL", "600")),
     "user_alias": os.getenv("DEV_NAME") or os.environ["USER"],
 }
 
@@ -39,19 +43,189 @@ def open(verbose):
 
 
 @cli.command()
-@click.argument("db", nargs=1, required=True)
-@click.argument("to", nargs=1, required=True)
+@click.argument("databases", nargs=-1)
 @click.option("--usage", "-u", multiple=True, help="Grant usage to role")
-def clone(db, to, usage):
-    """Clone a database"""
-    from vdc.clone import create_db_clone
+@click.option(
+    "--mapping-file",
+    "-f",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Yaml file mapping source databases to destination databases, one SRC: DST per line",
+)
+@click.option(
+    "--max-concurrency",
+    default=8,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of dynamic table suspends and grants run concurrently per database",
+)
+@click.option(
+    "--max-parallel",
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of databases cloned in parallel",
+)
+@click.option(
+    "--schema",
+    "-s",
+    multiple=True,
+    help="Only clone this schema into TO, keeping the rest of TO",
+)
+@click.option(
+    "--table",
+    "-t",
+    multiple=True,
+    help="Only clone this schema.table into TO, keeping the rest of TO",
+)
+@click.option(
+    "--refresh-stale",
+    is_flag=True,
+    default=False,
+    help="Only clone the tables altered in DB since they were cloned to TO, and schemas and tables missing in TO. Can be limited with --schema and --table",
+)
+@click.option(
+    "--plan",
+    is_flag=True,
+    default=False,
+    help="Print the statements the clone would run and an estimate of its round trips, without cloning",
+)
+def clone(
+    databases,
+    usage,
+    mapping_file,
+    max_concurrency,
+    max_parallel,
+    schema,
+    table,
+    refresh_stale,
+    plan,
+):
+    """Clone one or more databases
+
+    DATABASES is either DB TO, or any number of SRC:DST pairs to clone many
+    databases in parallel. A database cloned from another clone in the same run
+    is cloned when that clone is done.
+
+    With --schema, --table or --refresh-stale only those objects are cloned
+    into TO, and everything else in TO is kept.
+    """
+    from vdc.clone import (
+        _clone_pairs,
+        _read_clone_mapping,
+        create_db_clone,
+        create_db_clones,
+        create_partial_clone,
+        plan_clone,
+    )
+
+    try:
+        pairs = _clone_pairs(databases)
+        if mapping_file:
+            pairs += _read_clone_mapping(mapping_file)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    if not pairs:
+        raise click.UsageError("Provide DB TO, SRC:DST pairs or --mapping-file")
+
+    partial = schema or table or refresh_stale
+    if partial and len(pairs) > 1:
+        raise click.UsageError(
+            "--schema, --table and --refresh-stale can only be used with one database"
+        )
+
+    if plan:
+        ok = all(
+            [
+                plan_clone(
+                    src=src,
+                    dst=dst,
+                    schemas=schema,
+                    tables=table,
+                    refresh_stale=refresh_stale,
+                    usage=usage,
+                    max_concurrency=max_concurrency,
+                )
+                for src, dst in pairs
+            ]
+        )
+    elif partial:
+        src, dst = pairs[0]
+        ok = create_partial_clone(
+            src=src,
+            dst=dst,
+            schemas=schema,
+            tables=table,
+            refresh_stale=refresh_stale,
+            usage=usage,
+            max_concurrency=max_concurrency,
+        )
+    elif len(pairs) == 1:
+        src, dst = pairs[0]
+        ok = create_db_clone(
+            src=src, dst=dst, usage=usage, max_concurrency=max_concurrency
+        )
+    else:
+        try:
+            ok = create_db_clones(
+                pairs=pairs,
+                usage=usage,
+                max_concurrency=max_concurrency,
+                max_parallel=max_parallel,
+            )
+        except ValueError as e:
+            raise click.UsageError(str(e))
+    if not ok:
+        exit(1)
 
-    create_db_clone(src=db, dst=to, usage=usage)
+
+def _compare_to(
+    table, compare_to_db=None, compare_to_schema=None, compare_to_table=None
+):
+    db, schema, table = table.split(".")
+
+    # If no compare_to_db is provided, try to use the default dev database name.
+    # It is either constructed from the DEV_NAME environment variable or falls back
+    # to the USER environment variable if it doesnt contain special characters.
+    compare_to_db = compare_to_db or f"dev_{config['user_alias']}_{db}"
+
+    compare_to_schema = compare_to_schema or schema
+    compare_to_table = compare_to_table or table
+    return f"{compare_to_db}.{compare_to_schema}.{compare_to_table}"
+
+
+def _changed_levels(changed_since, dbt_project_dir, dbt_profile_dir, dbt_target):
+    from pathlib import Path
+
+    from vdc.manifest import _read_manifest, changed_relations
+    from vdc.waste import _create_dbt_manifest
+
+    base_manifest = None
+    git_ref = changed_since
+    if Path(changed_since).is_file():
+        # Read before compiling, as it may be the manifest that is overwritten
+        base_manifest = _read_manifest(Path(changed_since))
+        git_ref = None
+    print("Compiling dbt project")
+    _create_dbt_manifest(
+        dbt_project_dir=dbt_project_dir,
+        dbt_profile_dir=dbt_profile_dir,
+        dbt_target=dbt_target,
+    )
+    levels = changed_relations(
+        manifest=_read_manifest(Path(dbt_project_dir) / "target" / "manifest.json"),
+        base_manifest=base_manifest,
+        git_ref=git_ref,
+        dbt_project_dir=dbt_project_dir,
+    )
+    print(
+        f"{sum(map(len, levels))} models changed since {changed_since} or downstream of a change"
+    )
+    return levels
 
 
 @cli.command()
-@click.argument("table", nargs=1, required=True)
-@click.argument("primary_key", nargs=1, required=True)
+@click.argument("table", nargs=1, required=False)
+@click.argument("primary_key", nargs=1, required=False)
 @click.option(
     "--compare-to-db",
     "-d",
@@ -69,6 +243,106 @@ def clone(db, to, usage):
 )
 @click.option("--column", "-c", multiple=True, help="Only compare column")
 @click.option("--ignore-column", "-i", multiple=True, help="Ignore column")
+@click.option(
+    "--server-side",
+    is_flag=True,
+    default=False,
+    help="Compute the diff in Snowflake with a full outer join on the primary key and only fetch the differing cells",
+)
+@click.option(
+    "--fingerprint/--no-fingerprint",
+    default=True,
+    help="Compare row counts and HASH_AGG fingerprints first and stop if the tables are identical",
+)
+@click.option(
+    "--bucketed",
+    is_flag=True,
+    default=False,
+    help="Locate the differences by recursively comparing fingerprints of primary key hash buckets and only fetch rows from mismatching buckets",
+)
+@click.option(
+    "--buckets",
+    default=16,
+    show_default=True,
+    type=click.IntRange(min=2),
+    help="Number of buckets each mismatching bucket is split into with --bucketed",
+)
+@click.option(
+    "--bucket-rows",
+    default=10000,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Stop splitting a bucket when it has at most this many rows with --bucketed",
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    default=False,
+    help="Fetch the diff in Arrow batches, spill it to local partition files and compare one partition at a time to keep memory bounded",
+)
+@click.option(
+    "--partitions",
+    default=64,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of primary key hash partitions used with --stream",
+)
+@click.option(
+    "--typed",
+    is_flag=True,
+    default=False,
+    help="Compare columns in their native types where both tables agree and only cast to varchar where the types differ",
+)
+@click.option(
+    "--where",
+    "-w",
+    help="Only compare rows matching this SQL predicate. It is applied to both tables",
+)
+@click.option(
+    "--sample",
+    type=click.FloatRange(min=0, max=100, min_open=True),
+    help="Only compare a deterministic sample of PCT percent of the primary keys",
+)
+@click.option(
+    "--sample-rows",
+    type=click.IntRange(min=1),
+    help="Only compare a deterministic sample of about N primary keys",
+)
+@click.option(
+    "--summary",
+    is_flag=True,
+    default=False,
+    help="Only print mismatch counts and numeric min/max deltas per column, aggregated in Snowflake without fetching any rows",
+)
+@click.option(
+    "--output",
+    "-o",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write the diff to this file without asking. The format is chosen from the extension: .parquet, .csv or .xlsx",
+)
+@click.option(
+    "--schema",
+    help="Diff every table in this db.schema that also exists in the compare to schema, instead of TABLE",
+)
+@click.option(
+    "--tables-file",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Diff the tables listed in this file instead of TABLE. One db.schema.table per line, optionally followed by a space and the comma separated primary key",
+)
+@click.option(
+    "--changed-since",
+    help="Diff the dbt models changed since this manifest.json or git ref, and their downstream models, instead of TABLE",
+)
+@click.option("--dbt-project-dir", default="dbt", help="Path to dbt project directory")
+@click.option("--dbt-profile-dir", default="dbt", help="Path to dbt profile directory")
+@click.option("--dbt-target", default="prod", help="dbt profile target")
+@click.option(
+    "--max-concurrency",
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of tables diffed concurrently with --schema, --tables-file or --changed-since",
+)
 def diff(
     table,
     primary_key,
@@ -77,28 +351,174 @@ def diff(
     compare_to_table,
     column,
     ignore_column,
+    server_side,
+    fingerprint,
+    bucketed,
+    buckets,
+    bucket_rows,
+    stream,
+    partitions,
+    typed,
+    where,
+    sample,
+    sample_rows,
+    summary,
+    output,
+    schema,
+    tables_file,
+    changed_since,
+    dbt_project_dir,
+    dbt_profile_dir,
+    dbt_target,
+    max_concurrency,
 ):
-    """Compare two tables in Snowflake"""
-    from vdc.diff import table_diff
+    """Compare two tables in Snowflake
 
-    full_table_name = table
-    db, schema, table = table.split(".")
+    PRIMARY_KEY is one or more comma separated columns, e.g. id or order_id,line_no.
+    If omitted, the primary key constraint declared on TABLE is used.
 
-    # If no compare_to_db is provided, try to use the default dev database name.
-    # It is either constructed from the DEV_NAME environment variable or falls back
-    # to the USER environment variable if it doesnt contain special characters.
-    compare_to_db = compare_to_db or f"dev_{config['user_alias']}_{db}"
+    With --schema, --tables-file or --changed-since many tables are
+    fingerprinted and their differing rows counted, and one consolidated report
+    is printed. --changed-since compiles the dbt project and diffs the models
+    changed since the given manifest.json or git ref, and their downstream
+    models, in DAG order.
+    """
+    from vdc.diff import _read_tables_file, batch_diff, table_diff
 
-    compare_to_schema = compare_to_schema or schema
-    compare_to_table = compare_to_table or table
-    compare_to = f"{compare_to_db}.{compare_to_schema}.{compare_to_table}"
+    if output and not output.lower().endswith((".parquet", ".csv", ".xlsx")):
+        raise click.BadParameter(
+            "must end with .parquet, .csv or .xlsx", param_hint="--output"
+        )
+    if schema or tables_file or changed_since:
+        if table or primary_key or compare_to_table:
+            raise click.UsageError(
+                "Cannot use TABLE, PRIMARY_KEY or --compare-to-table with --schema, --tables-file or --changed-since"
+            )
+        if sum(map(bool, [schema, tables_file, changed_since])) > 1:
+            raise click.UsageError(
+                "Use only one of --schema, --tables-file and --changed-since"
+            )
+        if (
+            server_side
+            or bucketed
+            or stream
+            or summary
+            or sample
+            or sample_rows
+            or typed
+            or not fingerprint
+        ):
+            raise click.UsageError(
+                "--server-side, --bucketed, --stream, --summary, --sample, --sample-rows, --typed and --no-fingerprint are only supported when diffing a single TABLE"
+            )
+        if schema and (len(schema.split(".")) != 2 or not all(schema.split("."))):
+            raise click.BadParameter("must be db.schema", param_hint="--schema")
+        if schema:
+            db, schema_name = schema.split(".")
+            compare_to_db = compare_to_db or f"dev_{config['user_alias']}_{db}"
+            batch_diff(
+                schema=schema,
+                compare_to_schema=f"{compare_to_db}.{compare_to_schema or schema_name}",
+                columns=column,
+                ignore_columns=ignore_column,
+                where=where,
+                output=output,
+                max_concurrency=max_concurrency,
+            )
+            return
+        if changed_since:
+            levels = _changed_levels(
+                changed_since=changed_since,
+                dbt_project_dir=dbt_project_dir,
+                dbt_profile_dir=dbt_profile_dir,
+                dbt_target=dbt_target,
+            )
+            if not levels:
+                print(f"No models changed since {changed_since}")
+                return
+            batch_diff(
+                levels=[
+                    [
+                        (
+                            relation,
+                            _compare_to(
+                                table=relation,
+                                compare_to_db=compare_to_db,
+                                compare_to_schema=compare_to_schema,
+                            ),
+                            None,
+                        )
+                        for relation in level
+                    ]
+                    for level in levels
+                ],
+                columns=column,
+                ignore_columns=ignore_column,
+                where=where,
+                output=output,
+                max_concurrency=max_concurrency,
+            )
+            return
+        batch_diff(
+            tables=[
+                (
+                    table_name,
+                    _compare_to(
+                        table=table_name,
+                        compare_to_db=compare_to_db,
+                        compare_to_schema=compare_to_schema,
+                    ),
+                    table_primary_key,
+                )
+                for table_name, table_primary_key in _read_tables_file(tables_file)
+            ],
+            columns=column,
+            ignore_columns=ignore_column,
+            where=where,
+            output=output,
+            max_concurrency=max_concurrency,
+        )
+        return
+    if not table:
+        raise click.UsageError(
+            "Provide TABLE, --schema, --tables-file or --changed-since"
+        )
+
+    if sample and sample_rows:
+        raise click.UsageError("Cannot use --sample and --sample-rows at the same time")
+    if summary and (server_side or bucketed or stream):
+        raise click.UsageError(
+            "Cannot use --summary with --server-side, --bucketed or --stream"
+        )
+    if server_side and (bucketed or stream):
+        raise click.UsageError("Cannot use --server-side with --bucketed or --stream")
+
+    compare_to = _compare_to(
+        table=table,
+        compare_to_db=compare_to_db,
+        compare_to_schema=compare_to_schema,
+        compare_to_table=compare_to_table,
+    )
 
     table_diff(
-        table=full_table_name,
+        table=table,
         primary_key=primary_key,
         compare_to=compare_to,
         columns=column,
         ignore_columns=ignore_column,
+        server_side=server_side,
+        fingerprint=fingerprint,
+        bucketed=bucketed,
+        buckets=buckets,
+        bucket_rows=bucket_rows,
+        stream=stream,
+        partitions=partitions,
+        typed=typed,
+        where=where,
+        sample=sample,
+        sample_rows=sample_rows,
+        summary=summary,
+        output=output,
     )
 
 
@@ -130,6 +550,16 @@ def waste():
     multiple=True,
     help="Mark object for removal. Supports marking database, schema and table. Example: --mark-object db.schema.table",
 )
+@click.option(
+    "--min-bytes",
+    type=click.IntRange(min=0),
+    help="Only suggest tables that would reclaim at least this many bytes of active, time travel and fail-safe storage",
+)
+@click.option(
+    "--unread-days",
+    type=click.IntRange(min=1),
+    help="Only suggest tables that have not been read for this many days",
+)
 def disposal(
     dbt_project_dir,
     dbt_profile_dir,
@@ -138,8 +568,15 @@ def disposal(
     ignore_table,
     schema,
     mark_object,
+    min_bytes,
+    unread_days,
 ):
-    """Mark db objects for removal"""
+    """Mark db objects for removal
+
+    Tables that are not in the dbt manifest are suggested, largest reclaimable
+    storage first, with when they were last read according to
+    snowflake.account_usage.
+    """
     from vdc.waste import mark_objects_for_removal
 
     if mark_object and dry_run == True:
@@ -154,6 +591,8 @@ def disposal(
         ignore_tables=ignore_table,
         schemas=schema,
         mark_object=mark_object,
+        min_bytes=min_bytes,
+        unread_days=unread_days,
     )
 
 
@@ -169,3 +608,44 @@ def incineration(dry_run):
     from vdc.waste import remove_marked_objects
 
     remove_marked_objects(dry_run=dry_run)
+
+
+@cli.group(name="session")
+def session():
+    """Commands for reusing one Snowflake login across vdc commands"""
+    pass
+
+
+@session.command()
+def start():
+    """Log in and keep the session alive in the background
+
+    Later vdc commands use this session instead of logging in, until it is
+    stopped or Snowflake expires it.
+    """
+    from vdc.session import start_session
+
+    start_session()
+
+
+@session.command()
+def stop():
+    """Stop the background session and remove the cached login"""
+    from vdc.session import stop_session
+
+    stop_session()
+
+
+@cli.group(name="cache")
+def cache():
+    """Commands for the local cache of Snowflake metadata"""
+    pass
+
+
+@cache.command()
+def clear():
+    """Remove all cached metadata"""
+    from vdc.cache import metadata_cache
+
+    metadata_cache().clear()
+    print("Metadata cache cleared")
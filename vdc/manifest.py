@@ -0,0 +1,333 @@
+import hashlib
+import json
+import subprocess
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import ijson
+
+from vdc import utils
+
+DIFFABLE_RESOURCE_TYPES = ["model", "snapshot", "seed"]
+INDEX_DIR = utils.CACHE_DIR / "manifest_index"
+STATE_DIR = utils.CACHE_DIR / "manifest_state"
+DEPS_FILES = ["packages.yml", "dependencies.yml", "package-lock.yml"]
+# Generated by dbt, not part of the project
+IGNORED_DIRS = {"target", "dbt_packages", "logs", "node_modules"}
+INDEX_FIELDS = {"resource_type", "relation_name", "database"}
+
+
+def _read_manifest(path: Path) -> dict:
+    if not path.exists():
+        raise FileNotFoundError(f"Manifest file not found at {path}")
+    return json.loads(path.read_text())
+
+
+def _is_db_object(section: str, node: dict) -> bool:
+    if not node.get("relation_name"):
+        return False
+    if section == "nodes":
+        return node.get("resource_type") in DIFFABLE_RESOURCE_TYPES
+    return node.get("resource_type") == "source"
+
+
+def _stream_db_objects(path: Path) -> tuple[set[str], set[str]]:
+    """Relation names and databases of the models, snapshots, seeds and sources
+    in a manifest.
+
+    The manifest is parsed as a stream of events, and only the few top level
+    fields of each node are kept, so memory stays flat however large the
+    compiled code and docs in it are.
+    """
+    tables, databases = set(), set()
+    depth = 0
+    section = field = None
+    node = {}
+    with open(path, "rb") as f:
+        for event, value in ijson.basic_parse(f):
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+                # The end of a node in nodes or sources
+                if depth == 2 and node:
+                    if _is_db_object(section, node):
+                        tables.add(node["relation_name"].lower())
+                        databases.add(node["database"])
+                    node = {}
+            elif event == "map_key":
+                if depth == 1:
+                    section = value
+                elif depth == 3:
+                    field = value
+            elif (
+                depth == 3 and section in ("nodes", "sources") and field in INDEX_FIELDS
+            ):
+                node[field] = value
+    return tables, databases
+
+
+def _file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _file_signature(path: Path) -> dict:
+    stat = path.stat()
+    return {
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha256": _file_sha256(path),
+    }
+
+
+def _is_same_file(path: Path, signature: Optional[dict]) -> bool:
+    """True if the file at path is the one signature was taken of, see
+    _file_signature. The sha256 is only compared if the mtime or size differ"""
+    if not signature or not path.exists():
+        return False
+    stat = path.stat()
+    if (stat.st_mtime_ns, stat.st_size) == (
+        signature["mtime_ns"],
+        signature["size"],
+    ):
+        return True
+    return _file_sha256(path) == signature["sha256"]
+
+
+def load_db_objects(path: Path) -> tuple[set[str], set[str]]:
+    """Relation names and databases in the manifest, see _stream_db_objects.
+
+    They are cached in an index keyed by the manifest's path. The index is
+    used when the manifest's mtime and size are unchanged, or else when its
+    sha256 is unchanged.
+    """
+    if not path.exists():
+        raise FileNotFoundError(f"Manifest file not found at {path}")
+    stat = path.stat()
+    index_path = (
+        INDEX_DIR / f"{hashlib.sha256(str(path.resolve()).encode()).hexdigest()}.json"
+    )
+    index = json.loads(index_path.read_text()) if index_path.exists() else {}
+    if (index.get("mtime_ns"), index.get("size")) != (stat.st_mtime_ns, stat.st_size):
+        sha256 = _file_sha256(path)
+        if index.get("sha256") != sha256:
+            tables, databases = _stream_db_objects(path)
+            index = {
+                "sha256": sha256,
+                "tables": sorted(tables),
+                "databases": sorted(databases),
+            }
+        index.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        index_path.write_text(json.dumps(index))
+    return set(index["tables"]), set(index["databases"])
+
+
+def _hash_files(sha256, root: Path, paths: Iterable[Path]):
+    for path in sorted(paths):
+        sha256.update(str(path.relative_to(root)).encode())
+        sha256.update(path.read_bytes())
+
+
+def _project_files(dbt_project_dir: Path) -> Iterator[Path]:
+    for path in dbt_project_dir.rglob("*"):
+        parts = path.relative_to(dbt_project_dir).parts
+        if parts[0] in IGNORED_DIRS or any(part.startswith(".") for part in parts):
+            continue
+        if path.is_file():
+            yield path
+
+
+def _deps_fingerprint(dbt_project_dir: Path) -> str:
+    sha256 = hashlib.sha256()
+    _hash_files(
+        sha256,
+        dbt_project_dir,
+        [
+            dbt_project_dir / name
+            for name in DEPS_FILES
+            if (dbt_project_dir / name).exists()
+        ],
+    )
+    return sha256.hexdigest()
+
+
+def _project_fingerprint(
+    dbt_project_dir: Path, dbt_profile_dir: Path, dbt_target: str
+) -> str:
+    """Hash of the project files, the installed packages, the profile and the
+    target, which together decide the manifest"""
+    sha256 = hashlib.sha256(dbt_target.encode())
+    _hash_files(sha256, dbt_project_dir, _project_files(dbt_project_dir))
+    profiles = dbt_profile_dir / "profiles.yml"
+    if profiles.exists():
+        sha256.update(profiles.read_bytes())
+    sha256.update(_deps_fingerprint(dbt_project_dir).encode())
+    return sha256.hexdigest()
+
+
+def _state_path(dbt_project_dir: Path) -> Path:
+    key = hashlib.sha256(str(dbt_project_dir.resolve()).encode()).hexdigest()
+    return STATE_DIR / f"{key}.json"
+
+
+def read_manifest_state(dbt_project_dir: Path) -> dict:
+    path = _state_path(dbt_project_dir)
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def write_manifest_state(dbt_project_dir: Path, state: dict):
+    path = _state_path(dbt_project_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(state))
+
+
+def _missing_relation_names(path: Path) -> bool:
+    """True if a model that is not ephemeral has no relation name, as in
+    manifests from older dbt versions' parse"""
+    with open(path, "rb") as f:
+        for _, node in ijson.kvitems(f, "nodes"):
+            if (
+                node.get("resource_type") in DIFFABLE_RESOURCE_TYPES
+                and node.get("config", {}).get("materialized") != "ephemeral"
+                and not node.get("relation_name")
+            ):
+                return True
+    return False
+
+
+def _diffable_nodes(manifest: dict) -> dict:
+    """Nodes that are materialized as a table or view in the warehouse"""
+    return {
+        unique_id: node
+        for unique_id, node in manifest["nodes"].items()
+        if node["resource_type"] in DIFFABLE_RESOURCE_TYPES
+        and node.get("config", {}).get("materialized") != "ephemeral"
+        and node.get("relation_name")
+    }
+
+
+def _modified_nodes(manifest: dict, base_manifest: dict) -> set[str]:
+    """Nodes whose checksum differ from the base manifest.
+
+    Nodes that are new since the base manifest are not included, as there is
+    nothing to compare them to.
+    """
+    base_nodes = base_manifest["nodes"]
+    return {
+        unique_id
+        for unique_id, node in _diffable_nodes(manifest).items()
+        if unique_id in base_nodes
+        and node["checksum"]["checksum"]
+        != base_nodes[unique_id]["checksum"]["checksum"]
+    }
+
+
+def _changed_files(git_ref: str, dbt_project_dir: str) -> set[str]:
+    """Files in the dbt project changed since git_ref, relative to the project"""
+    run_result = subprocess.run(
+        ["git", "diff", "--name-only", "--relative", git_ref, "--", "."],
+        cwd=dbt_project_dir,
+        capture_output=True,
+        text=True,
+    )
+    if run_result.returncode != 0:
+        raise ValueError(f"Could not diff against {git_ref}: {run_result.stderr}")
+    return set(run_result.stdout.split())
+
+
+def _nodes_in_files(manifest: dict, files: Iterable[str]) -> set[str]:
+    """Nodes defined or documented in any of the files"""
+    files = {Path(file).as_posix() for file in files}
+    nodes = set()
+    for unique_id, node in _diffable_nodes(manifest).items():
+        patch_path = (node.get("patch_path") or "").split("://", 1)[-1]
+        if node["original_file_path"] in files or patch_path in files:
+            nodes.add(unique_id)
+    return nodes
+
+
+def _with_downstream(manifest: dict, unique_ids: Iterable[str]) -> set[str]:
+    nodes = set()
+    pending = list(unique_ids)
+    while pending:
+        unique_id = pending.pop()
+        if unique_id in nodes:
+            continue
+        nodes.add(unique_id)
+        pending.extend(manifest["child_map"].get(unique_id, []))
+    return nodes & _diffable_nodes(manifest).keys()
+
+
+def _upstream_in(manifest: dict, unique_id: str, unique_ids: set[str]) -> set[str]:
+    """Nearest upstream nodes of unique_id among unique_ids, looking through
+    nodes that are not among them, e.g. ephemeral models"""
+    upstream = set()
+    seen = set()
+    pending = list(manifest["parent_map"].get(unique_id, []))
+    while pending:
+        parent = pending.pop()
+        if parent in seen:
+            continue
+        seen.add(parent)
+        if parent in unique_ids:
+            upstream.add(parent)
+        else:
+            pending.extend(manifest["parent_map"].get(parent, []))
+    return upstream
+
+
+def _dag_levels(manifest: dict, unique_ids: Iterable[str]) -> list[list[str]]:
+    """Group the nodes in levels so every node comes after its upstream nodes"""
+    unique_ids = set(unique_ids)
+    parents = {
+        unique_id: _upstream_in(manifest, unique_id, unique_ids)
+        for unique_id in unique_ids
+    }
+    levels = []
+    done = set()
+    while len(done) < len(unique_ids):
+        level = sorted(
+            unique_id for unique_id in unique_ids - done if parents[unique_id] <= done
+        )
+        if not level:
+            raise ValueError(f"Cycle in manifest between {sorted(unique_ids - done)}")
+        levels.append(level)
+        done.update(level)
+    return levels
+
+
+def _relation(node: dict) -> str:
+    return node["relation_name"].replace('"', "").lower()
+
+
+def changed_relations(
+    manifest: dict,
+    base_manifest: Optional[dict] = None,
+    git_ref: Optional[str] = None,
+    dbt_project_dir: str = "dbt",
+) -> list[list[str]]:
+    """Relations of the nodes changed since base_manifest or git_ref, and their
+    downstream nodes, in DAG levels.
+
+    Against a base manifest nodes are compared by checksum. Against a git ref
+    the nodes defined in the files changed since the ref are used.
+    """
+    if base_manifest is not None:
+        modified = _modified_nodes(manifest=manifest, base_manifest=base_manifest)
+    else:
+        modified = _nodes_in_files(
+            manifest=manifest,
+            files=_changed_files(git_ref=git_ref, dbt_project_dir=dbt_project_dir),
+        )
+    nodes = manifest["nodes"]
+    return [
+        [_relation(nodes[unique_id]) for unique_id in level]
+        for level in _dag_levels(
+            manifest=manifest, unique_ids=_with_downstream(manifest, modified)
+        )
+    ]
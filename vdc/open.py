@@ -204,9 +204,11 @@ def _replace_dev_database(prod_target_database, selected_database, selected_role
         prod_target_database != selected_database
     )  # should not happen because of validate_target
 
-    create_db_clone(
+    if not create_db_clone(
         src=prod_target_database, dst=selected_database, usage=(selected_role,)
-    )
+    ):
+        LOGGER.error("Failed to replace database")
+        exit(1)
     print("Database replaced")
     print("")
 
@@ -0,0 +1,165 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
+
+EXCEL_MAX_ROWS = 1048576
+
+
+def _index_names(df: pd.DataFrame) -> list[str]:
+    """Unnamed index levels hold the table names of a diff"""
+    return [name or "table" for name in df.index.names]
+
+
+class ReportWriter(ABC):
+    """Write a report incrementally, one DataFrame batch at a time.
+
+    The index of each batch is written as columns. All batches are written
+    with the columns of the first batch, or with `columns` after the index
+    columns if given, so batches with only some of the columns line up.
+    """
+
+    def __init__(self, path: Path, columns: Optional[list[str]] = None):
+        self.path = path
+        self.value_columns = columns
+        self.columns = None
+        self.rows = 0
+
+    def write(self, df: pd.DataFrame):
+        index_columns = _index_names(df)
+        df = df.rename_axis(index=index_columns).reset_index()
+        if self.columns is None:
+            value_columns = self.value_columns or [
+                column for column in df.columns if column not in index_columns
+            ]
+            self.columns = index_columns + value_columns
+        df = df.reindex(columns=self.columns)
+        self._write(df)
+        self.rows += len(df)
+
+    @abstractmethod
+    def _write(self, df: pd.DataFrame):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvReportWriter(ReportWriter):
+    def __init__(self, path: Path, columns: Optional[list[str]] = None):
+        super().__init__(path, columns)
+        self.file = open(path, "w", newline="")
+
+    def _write(self, df: pd.DataFrame):
+        df.to_csv(self.file, header=self.rows == 0, index=False)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetReportWriter(ReportWriter):
+    """Every batch is written as its own row group"""
+
+    def __init__(self, path: Path, columns: Optional[list[str]] = None):
+        super().__init__(path, columns)
+        self.writer = None
+
+    def _write(self, df: pd.DataFrame):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # Columns without values, e.g. the columns that do not differ in this
+        # batch, come out of pandas as double. They are typed as null instead
+        # so they can be cast to the type of the file
+        table = pa.table(
+            [
+                pa.nulls(len(column)) if column.null_count == len(column) else column
+                for column in table.columns
+            ],
+            names=table.column_names,
+        )
+        if self.writer is None:
+            # Columns that are empty in the first batch get a type that fits the
+            # varchar values of a diff, instead of the null type
+            schema = pa.schema(
+                [
+                    (
+                        field.with_type(pa.string())
+                        if pa.types.is_null(field.type)
+                        else field
+                    )
+                    for field in table.schema
+                ]
+            )
+            self.writer = pq.ParquetWriter(str(self.path), schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+
+
+class ExcelReportWriter(ReportWriter):
+    """Written in xlsxwriter's constant_memory mode, row by row.
+
+    A new sheet is started when a sheet reaches Excel's row limit.
+    """
+
+    def __init__(self, path: Path, columns: Optional[list[str]] = None):
+        super().__init__(path, columns)
+        self.workbook = xlsxwriter.Workbook(
+            str(path),
+            {
+                "constant_memory": True,
+                "default_date_format": "yyyy-mm-dd hh:mm:ss",
+                "remove_timezone": True,
+            },
+        )
+        self.sheet = None
+        self.sheet_row = 0
+
+    def _add_sheet(self):
+        sheets = len(self.workbook.worksheets())
+        name = "diff" if sheets == 0 else f"diff_{sheets + 1}"
+        self.sheet = self.workbook.add_worksheet(name)
+        self.sheet.write_row(0, 0, [str(column) for column in self.columns or []])
+        self.sheet_row = 1
+
+    def _write(self, df: pd.DataFrame):
+        df = df.astype(object).where(df.notna(), None)
+        for row in df.itertuples(index=False, name=None):
+            if self.sheet is None or self.sheet_row == EXCEL_MAX_ROWS:
+                self._add_sheet()
+            self.sheet.write_row(self.sheet_row, 0, row)
+            self.sheet_row += 1
+
+    def close(self):
+        if self.sheet is None:
+            self._add_sheet()
+        self.workbook.close()
+
+
+REPORT_WRITERS = {
+    ".csv": CsvReportWriter,
+    ".parquet": ParquetReportWriter,
+    ".xlsx": ExcelReportWriter,
+}
+
+
+def open_report(path: str, columns: Optional[list[str]] = None) -> ReportWriter:
+    path = Path(path)
+    writer = REPORT_WRITERS.get(path.suffix.lower())
+    if writer is None:
+        raise ValueError(
+            f"Unsupported report format {path.suffix}. Use one of {', '.join(REPORT_WRITERS)}"
+        )
+    return writer(path, columns)
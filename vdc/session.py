@@ -0,0 +1,315 @@
+import atexit
+import itertools
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import snowflake.connector
+from snowflake.connector import SnowflakeConnection
+from snowflake.connector.cursor import SnowflakeCursor
+
+from vdc import utils
+
+try:
+    from snowflake.connector.token_cache import TokenCache, TokenKey, TokenType
+except ImportError:
+    # Connectors older than the token cache cannot share a session
+    TokenCache = None
+
+LOGGER = logging.getLogger(__name__)
+
+SESSION_FILE = utils.CACHE_DIR / "session.json"
+KEEP_ALIVE_INTERVAL = 15 * 60
+SHARED_SESSION_SETTINGS = ["account", "user", "role", "warehouse"]
+SESSION_TOKENS = ["session_token", "master_token"]
+
+
+class SessionPool:
+    """A fixed number of Snowflake connections shared by every command.
+
+    Connections are opened on first use and reused until the process exits,
+    so a command logs in at most once per connection. Snowflake connections
+    can be used from several threads at once, so connections are handed out
+    round robin instead of being checked out exclusively.
+    """
+
+    def __init__(self, snowflake_config: dict, size: int = 1):
+        self.snowflake_config = {
+            key: value for key, value in snowflake_config.items() if value is not None
+        }
+        self.size = size
+        self._connections = [None] * size
+        self._next = itertools.cycle(range(size))
+        self._lock = threading.Lock()
+
+    def _connect(self) -> SnowflakeConnection:
+        shared_session = _read_shared_session(self.snowflake_config)
+        if shared_session:
+            try:
+                return _connect_to_shared_session(self.snowflake_config, shared_session)
+            except snowflake.connector.errors.Error as e:
+                LOGGER.info(f"Could not reuse the session from vdc session start. {e}")
+        LOGGER.info(f"Connecting to Snowflake as {self.snowflake_config.get('user')}")
+        return snowflake.connector.connect(**self.snowflake_config)
+
+    def connection(self) -> SnowflakeConnection:
+        with self._lock:
+            slot = next(self._next)
+            ctx = self._connections[slot]
+            if ctx is None or ctx.is_closed():
+                ctx = self._connections[slot] = self._connect()
+            return ctx
+
+    def close(self):
+        with self._lock:
+            for ctx in self._connections:
+                if ctx is not None and not ctx.is_closed():
+                    ctx.close()
+            self._connections = [None] * self.size
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _session_pool() -> SessionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SessionPool(
+                snowflake_config=utils.config["snowflake"],
+                size=utils.config.get("session_pool_size", 1),
+            )
+            atexit.register(_pool.close)
+        return _pool
+
+
+def get_connection() -> SnowflakeConnection:
+    """A pooled connection. It must not be closed by the caller"""
+    return _session_pool().connection()
+
+
+@contextmanager
+def connection() -> Iterator[SnowflakeConnection]:
+    """A pooled connection. It is left open for the next user when the block exits"""
+    yield get_connection()
+
+
+@contextmanager
+def cursor(cursor_class=SnowflakeCursor) -> Iterator[SnowflakeCursor]:
+    """A cursor on a pooled connection, closed when the block exits"""
+    with connection() as ctx:
+        with ctx.cursor(cursor_class) as cur:
+            yield cur
+
+
+def _read_session_file() -> Optional[dict]:
+    if not SESSION_FILE.exists():
+        return None
+    return json.loads(SESSION_FILE.read_text())
+
+
+def _write_session_file(session: dict):
+    SESSION_FILE.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(SESSION_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(session, f)
+
+
+def _token_key(session: dict) -> "TokenKey":
+    # Told apart from the connector's own tokens for the user by the suffix.
+    # Same argument order as the connector uses when it stores a token.
+    return TokenKey(
+        session["host"], f"{session['user']}:vdc-session", TokenType.ID_TOKEN
+    )
+
+
+def _store_tokens(session: dict):
+    """Store the session's tokens in the connector's token cache, which is the
+    keyring on macOS and Windows and a file only the user may read on Linux"""
+    TokenCache.make().store(
+        _token_key(session),
+        json.dumps({token: session[token] for token in SESSION_TOKENS}),
+    )
+
+
+def _read_tokens(session: dict) -> Optional[dict]:
+    if TokenCache is None:
+        return None
+    tokens = TokenCache.make().retrieve(_token_key(session))
+    return json.loads(tokens) if tokens else None
+
+
+def _remove_tokens(session: dict):
+    if TokenCache is not None:
+        TokenCache.make().remove(_token_key(session))
+
+
+def _write_session(session: dict):
+    """Store the tokens in the token cache and the rest in SESSION_FILE"""
+    _store_tokens(session)
+    _write_session_file(
+        {key: value for key, value in session.items() if key not in SESSION_TOKENS}
+    )
+
+
+def _is_running(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_shared_session(snowflake_config: dict) -> Optional[dict]:
+    """The session kept alive by vdc session start, if it is still running and
+    was started with the same account, user, role and warehouse"""
+    session = _read_session_file()
+    if not session or not _is_running(session.get("pid")):
+        return None
+    for setting in SHARED_SESSION_SETTINGS:
+        if session.get(setting) != snowflake_config.get(setting):
+            return None
+    tokens = _read_tokens(session)
+    if not tokens:
+        return None
+    return {**session, **tokens}
+
+
+def _connect_to_shared_session(
+    snowflake_config: dict, session: dict, **kwargs
+) -> SnowflakeConnection:
+    """Connect with the tokens of an existing session instead of logging in.
+
+    With server_session_keep_alive closing the connection does not log out of
+    the session, so it can be reused by the next command.
+    """
+    kwargs.setdefault("server_session_keep_alive", True)
+    return snowflake.connector.connect(
+        **snowflake_config,
+        session_token=session["session_token"],
+        master_token=session["master_token"],
+        **kwargs,
+    )
+
+
+def _session_state(ctx: SnowflakeConnection, snowflake_config: dict) -> dict:
+    return {
+        **{
+            setting: snowflake_config.get(setting)
+            for setting in SHARED_SESSION_SETTINGS
+        },
+        "host": ctx.host,
+        "session_token": ctx.rest.token,
+        "master_token": ctx.rest.master_token,
+    }
+
+
+def start_session():
+    """Log in once and keep the session alive in a background process, so
+    later commands can use the session without logging in"""
+    session = _read_session_file()
+    if session and _is_running(session.get("pid")):
+        print(f"Session is already kept alive by process {session['pid']}")
+        return
+    if TokenCache is None:
+        print(
+            "vdc session needs a snowflake-connector-python with a token cache, "
+            "upgrade it with pip install -U snowflake-connector-python"
+        )
+        exit(1)
+    snowflake_config = _session_pool().snowflake_config
+    ctx = snowflake.connector.connect(
+        **snowflake_config, server_session_keep_alive=True
+    )
+    state = _session_state(ctx, snowflake_config)
+    ctx.close()
+    _write_session(state)
+    if not _read_tokens(state):
+        print("Could not store the session in the token cache")
+        SESSION_FILE.unlink()
+        exit(1)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "vdc.session"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    _write_session({**state, "pid": process.pid})
+    print(
+        f"Session is kept alive by process {process.pid}. Stop it with vdc session stop"
+    )
+
+
+def _keep_alive():
+    """Run a query every KEEP_ALIVE_INTERVAL seconds to keep the session from
+    timing out, and write back the tokens if the connector renewed them. Stops
+    when the session file no longer names this process."""
+    session = _read_session_file()
+    snowflake_config = {
+        setting: session[setting] for setting in SHARED_SESSION_SETTINGS
+    }
+    tokens = _read_tokens(session)
+    ctx = _connect_to_shared_session(snowflake_config, {**session, **tokens})
+    while True:
+        time.sleep(KEEP_ALIVE_INTERVAL)
+        session = _read_session_file()
+        if not session or session.get("pid") != os.getpid():
+            break
+        ctx.cursor().execute("select 1")
+        state = _session_state(ctx, snowflake_config)
+        if state["session_token"] != tokens["session_token"]:
+            _store_tokens(state)
+            tokens = {token: state[token] for token in SESSION_TOKENS}
+    ctx.close()
+
+
+def _remove_cached_id_token(host: str, user: str):
+    # Same argument order as the connector uses when it stores the token
+    TokenCache.make().remove(TokenKey(host, user, TokenType.ID_TOKEN))
+
+
+def stop_session():
+    """Stop the keep alive process, log out of its session and remove the
+    cached SSO token, so the next command has to log in again"""
+    snowflake_config = _session_pool().snowflake_config
+    host = f"{snowflake_config['account']}.snowflakecomputing.com"
+    session = _read_session_file()
+    if session:
+        host = session["host"]
+        if _is_running(session.get("pid")):
+            os.kill(session["pid"], signal.SIGTERM)
+        tokens = _read_tokens(session)
+        if tokens:
+            try:
+                ctx = _connect_to_shared_session(
+                    {setting: session[setting] for setting in SHARED_SESSION_SETTINGS},
+                    {**session, **tokens},
+                    server_session_keep_alive=False,
+                )
+                ctx.close()
+            except snowflake.connector.errors.Error:
+                # The session has already expired
+                pass
+        _remove_tokens(session)
+        SESSION_FILE.unlink()
+        print("Session stopped")
+    if TokenCache is not None:
+        _remove_cached_id_token(host=host, user=snowflake_config["user"])
+        print("Removed cached login")
+
+
+if __name__ == "__main__":
+    _keep_alive()
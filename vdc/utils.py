@@ -1,4 +1,6 @@
 import logging
+import os
+from pathlib import Path
 from shutil import which
 
 from alive_progress import alive_bar
@@ -7,6 +9,8 @@ LOGGER = logging.getLogger(__name__)
 
 config = None
 
+CACHE_DIR = Path(os.getenv("XDG_CACHE_HOME", Path.home() / ".cache")) / "vdc"
+
 
 def set_config(new_config):
     global config
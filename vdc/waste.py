@@ -1,32 +1,37 @@
 import datetime
-import json
 import os
 import subprocess
+import time
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Optional
 
 import questionary
-import snowflake.connector
 from questionary import Choice
 from snowflake.connector import DictCursor
 
+from vdc import cache, session
+from vdc.manifest import (
+    _deps_fingerprint,
+    _file_signature,
+    _is_same_file,
+    _missing_relation_names,
+    _project_fingerprint,
+    load_db_objects,
+    read_manifest_state,
+    write_manifest_state,
+)
 from vdc.utils import _validate_program, config
 
+# How far back access_history is searched for the last read of a table
+USAGE_LOOKBACK_DAYS = 90
 
-def _snow_connection():
-    snowflake_config = config["snowflake"]
-
-    return snowflake.connector.connect(**snowflake_config).cursor(DictCursor)
-
-
-def _create_dbt_manifest(
-    dbt_project_dir: str = "dbt", dbt_profile_dir: str = "dbt", dbt_target: str = "prod"
-):
 
+def _run_dbt(command: str, dbt_project_dir: str, dbt_profile_dir: str, dbt_target: str):
+    started = time.monotonic()
     run_result = subprocess.run(
         [
             "dbt",
-            "deps",
+            command,
             "--target",
             dbt_target,
             "--profiles-dir",
@@ -40,43 +45,59 @@ def _create_dbt_manifest(
         print("Error running command:", run_result.stderr)
         print("Command output:", run_result.stdout)
         exit(1)
-    run_result = subprocess.run(
-        [
-            "dbt",
-            "compile",
-            "--target",
-            dbt_target,
-            "--profiles-dir",
-            dbt_profile_dir,
-            "--project-dir",
-            dbt_project_dir,
-        ],
-        capture_output=True,
+    print(f"dbt {command}: {time.monotonic() - started:.1f}s")
+
+
+def _create_dbt_manifest(
+    dbt_project_dir: str = "dbt", dbt_profile_dir: str = "dbt", dbt_target: str = "prod"
+):
+    """Create target/manifest.json with dbt parse, or with dbt compile if the
+    installed dbt does not set relation names when parsing.
+
+    dbt deps is skipped if the package files are unchanged since it last ran,
+    and everything is skipped if the project, packages, profile and target are
+    unchanged since the manifest was created, and the manifest has not been
+    rewritten since, e.g. by dbt run with another target.
+    """
+    project_dir = Path(dbt_project_dir)
+    manifest = project_dir / "target" / "manifest.json"
+    state = read_manifest_state(project_dir)
+    fingerprint = _project_fingerprint(
+        dbt_project_dir=project_dir,
+        dbt_profile_dir=Path(dbt_profile_dir),
+        dbt_target=dbt_target,
     )
-    if run_result.returncode != 0:
-        print("Error running command:", run_result.stderr)
-        print("Command output:", run_result.stdout)
-        exit(1)
+    if state.get("manifest") == fingerprint and _is_same_file(
+        manifest, state.get("manifest_file")
+    ):
+        print("dbt manifest is up to date, skipping dbt deps and dbt parse")
+        return
+
+    dbt_args = dict(
+        dbt_project_dir=dbt_project_dir,
+        dbt_profile_dir=dbt_profile_dir,
+        dbt_target=dbt_target,
+    )
+    deps = _deps_fingerprint(project_dir)
+    if state.get("deps") != deps or not (project_dir / "dbt_packages").exists():
+        _run_dbt("deps", **dbt_args)
+        # dbt deps may write package-lock.yml
+        state["deps"] = _deps_fingerprint(project_dir)
+        write_manifest_state(project_dir, state)
+    _run_dbt("parse", **dbt_args)
+    if _missing_relation_names(manifest):
+        _run_dbt("compile", **dbt_args)
+    state["manifest"] = _project_fingerprint(
+        dbt_project_dir=project_dir,
+        dbt_profile_dir=Path(dbt_profile_dir),
+        dbt_target=dbt_target,
+    )
+    state["manifest_file"] = _file_signature(manifest)
+    write_manifest_state(project_dir, state)
 
 
 def _get_db_objects_from_manifest(path: Path = Path("dbt/target/manifest.json")):
-    if not path.exists():
-        raise FileNotFoundError(f"Manifest file not found at {path}")
-    manifest = json.loads(path.read_text())
-    databases = set()
-    dbt_tables = set()
-
-    for node in manifest["nodes"].values():
-        if node["resource_type"] in ["model", "snapshot", "seed"]:
-            fqn = node["relation_name"].lower()
-            dbt_tables.add(fqn)
-            databases.add(node["database"])
-    for source in manifest["sources"].values():
-        if source["resource_type"] == "source":
-            fqn = source["relation_name"].lower()
-            dbt_tables.add(fqn)
-            databases.add(source["database"])
-    return dbt_tables, databases
+    return load_db_objects(path)
 
 
 def _object_type(object_name: str) -> str:
@@ -107,6 +128,145 @@ def _dispose_objects_query_builder(
     return queries
 
 
+def _union_all(queries: list[str]) -> str:
+    return "\nunion all\n".join(queries)
+
+
+def _schemata_query(databases: list[str]) -> str:
+    """Schemas of all the databases in one query"""
+    return _union_all(
+        [
+            f"select catalog_name, schema_name from {database}.information_schema.schemata where schema_name not in ('PUBLIC', 'INFORMATION_SCHEMA')"
+            for database in sorted(databases)
+        ]
+    )
+
+
+def _tables_query(databases: list[str], schemas: list[str]) -> str:
+    """Tables in the schemas of all the databases in one query"""
+    return _union_all(
+        [
+            f"select table_catalog, table_schema, table_name, last_altered from {database}.information_schema.tables where table_schema in ({','.join(sorted(schemas))})"
+            for database in sorted(databases)
+        ]
+    )
+
+
+def _scope(databases: list[str]) -> str:
+    """Metadata cache scope of a query over the databases"""
+    if len(databases) == 1:
+        return next(iter(databases))
+    return cache.ACCOUNT_SCOPE
+
+
+def _find_candidate_tables(
+    tables: Iterable[dict],
+    dbt_tables: set[str],
+    ignore_tables: Iterable[str] = (),
+) -> list[dict]:
+    """Tables from information_schema that are not in dbt, sorted by name.
+
+    A table is kept by dbt if its name, or its name with a __transient
+    suffix, is a relation in the manifest. Tables in PUBLIC, ignored tables
+    and tables already marked for removal are skipped.
+    """
+    known = set(dbt_tables)
+    known.update(table.removesuffix("__transient") for table in dbt_tables)
+    known.update(ignore_tables)
+    candidates = []
+    for table in tables:
+        if table["TABLE_SCHEMA"] in ("PUBLIC", "INFORMATION_SCHEMA"):
+            continue
+        name = f"{table['TABLE_CATALOG']}.{table['TABLE_SCHEMA']}.{table['TABLE_NAME']}".lower()
+        if name in known or "drp" in name:
+            continue
+        candidates.append({"name": name, "last_altered": table["LAST_ALTERED"]})
+    candidates.sort(key=lambda table: table["name"])
+    return candidates
+
+
+def _usage_query(
+    databases: Iterable[str], schemas: Iterable[str], lookback_days: int
+) -> str:
+    """Storage and the last read within lookback_days of every table in the
+    schemas of the databases, from account_usage in one query"""
+    catalogs = ",".join(sorted(f"'{database.upper()}'" for database in databases))
+    return f"""
+with storage as (
+    select
+        lower(table_catalog || '.' || table_schema || '.' || table_name) as name,
+        sum(active_bytes) as active_bytes,
+        sum(time_travel_bytes) as time_travel_bytes,
+        sum(failsafe_bytes) as failsafe_bytes
+    from snowflake.account_usage.table_storage_metrics
+    where not deleted
+        and table_catalog in ({catalogs})
+        and table_schema in ({",".join(sorted(schemas))})
+    group by 1
+),
+reads as (
+    select
+        lower(accessed.value:"objectName"::varchar) as name,
+        max(access_history.query_start_time) as last_read
+    from snowflake.account_usage.access_history,
+        lateral flatten(access_history.base_objects_accessed) accessed
+    where access_history.query_start_time >= dateadd(day, -{lookback_days}, current_timestamp())
+        and accessed.value:"objectDomain"::varchar = 'Table'
+        and split_part(accessed.value:"objectName"::varchar, '.', 1) in ({catalogs})
+    group by 1
+)
+select storage.*, reads.last_read
+from storage
+left join reads on reads.name = storage.name
+"""
+
+
+def _rank_candidate_tables(
+    candidates: list[dict],
+    usage: Iterable[dict],
+    now: datetime.datetime,
+    min_bytes: Optional[int] = None,
+    unread_days: Optional[int] = None,
+) -> list[dict]:
+    """Candidates with their storage and last read, sorted by the bytes that
+    dropping them would reclaim, largest first.
+
+    With min_bytes only candidates reclaiming at least that many bytes are
+    kept, and with unread_days only candidates not read for that many days.
+    """
+    usage = {row["NAME"]: row for row in usage}
+    ranked = []
+    for candidate in candidates:
+        row = usage.get(candidate["name"], {})
+        active, time_travel, failsafe = (
+            row.get(column) or 0
+            for column in ["ACTIVE_BYTES", "TIME_TRAVEL_BYTES", "FAILSAFE_BYTES"]
+        )
+        candidate = {
+            **candidate,
+            "reclaimable_bytes": active + time_travel + failsafe,
+            "last_read": row.get("LAST_READ"),
+        }
+        if min_bytes is not None and candidate["reclaimable_bytes"] < min_bytes:
+            continue
+        if (
+            unread_days is not None
+            and candidate["last_read"] is not None
+            and candidate["last_read"] > now - datetime.timedelta(days=unread_days)
+        ):
+            continue
+        ranked.append(candidate)
+    ranked.sort(key=lambda table: (-table["reclaimable_bytes"], table["name"]))
+    return ranked
+
+
+def _format_bytes(size: int) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if size < 1024 or unit == "TiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
 def _ask_about_database_and_schemas(databases) -> tuple[str]:
     selected_databases = questionary.checkbox(
         "Which databases do you want to inspect?",
@@ -116,18 +276,18 @@ def _ask_about_database_and_schemas(databases) -> tuple[str]:
         print("Aborting...")
         return
     existing_schemas = []
-    with _snow_connection() as cursor:
-        for database in selected_databases:
-            query = f"select catalog_name, schema_name from {database}.information_schema.schemata where schema_name not in ('PUBLIC', 'INFORMATION_SCHEMA')"
-            cursor.execute(query)
-            result = cursor.fetchall()
-            if not result:
-                print(f"Database {database} does not exist or is empty.")
-                continue
-            for row in result:
-                existing_schemas.append(
-                    f"{row['CATALOG_NAME']}.{row['SCHEMA_NAME']}".lower()
-                )
+    with session.cursor(DictCursor) as cursor:
+        for row in cache.stream_cached_query(
+            cursor,
+            _schemata_query(databases=selected_databases),
+            scope=_scope(selected_databases),
+        ):
+            existing_schemas.append(
+                f"{row['CATALOG_NAME']}.{row['SCHEMA_NAME']}".lower()
+            )
+    for database in selected_databases:
+        if not any(schema.startswith(f"{database}.") for schema in existing_schemas):
+            print(f"Database {database} does not exist or is empty.")
     existing_schemas.sort()
     existing_schemas = [schema for schema in existing_schemas if "drp" not in schema]
     default_schemas = []
@@ -167,6 +327,8 @@ def mark_objects_for_removal(
     ignore_tables: Optional[tuple[str]] = None,
     schemas: Optional[tuple[str]] = None,
     mark_object: Optional[tuple[str]] = None,
+    min_bytes: Optional[int] = None,
+    unread_days: Optional[int] = None,
 ):
     if ignore_tables:
         for table in ignore_tables:
@@ -191,9 +353,6 @@ def mark_objects_for_removal(
         dbt_tables, databases = _get_db_objects_from_manifest(
             path=Path(f"{dbt_project_dir}/target/manifest.json")
         )
-        dbt_tables_not_transient = set(
-            table.removesuffix("__transient") for table in dbt_tables
-        )
         databases = sorted(databases)
         if not schemas:
             schemas = _ask_about_database_and_schemas(databases=databases)
@@ -206,44 +365,43 @@ def mark_objects_for_removal(
             print("Aborting...")
             return
 
-        existing_table = []
-        with _snow_connection() as cursor:
-            for database in selected_databases:
-                query = f"select table_catalog, table_schema, table_name, last_altered from {database}.information_schema.tables where table_schema in ({','.join(selected_schemas)})"
-                cursor.execute(query)
-                result = cursor.fetchall()
-                for row in result:
-                    existing_table.append(row)
-        potential_drepcation_tables = []
-        for table in existing_table:
-            assert (
-                table["TABLE_CATALOG"].lower() in selected_databases
-            ), "not in {selected_databases}"
-            if table["TABLE_SCHEMA"] == "PUBLIC":
-                continue
-            if table["TABLE_SCHEMA"] == "INFORMATION_SCHEMA":
-                continue
-            db_table = f"{table['TABLE_CATALOG']}.{table['TABLE_SCHEMA']}.{table['TABLE_NAME']}".lower()
-            if ignore_tables and db_table in ignore_tables:
-                continue
-            if db_table in dbt_tables:
-                continue
-            if db_table in dbt_tables_not_transient:
-                continue
-            if "drp" in db_table:
-                continue
-            choice = Choice(
-                title=f"{db_table}".ljust(110)
-                + f"Last altered: {table['LAST_ALTERED']}",
-                value=db_table,
+        with session.cursor(DictCursor) as cursor:
+            potential_drepcation_tables = _find_candidate_tables(
+                tables=cache.stream_cached_query(
+                    cursor,
+                    _tables_query(
+                        databases=selected_databases, schemas=selected_schemas
+                    ),
+                    scope=_scope(selected_databases),
+                ),
+                dbt_tables=dbt_tables,
+                ignore_tables=ignore_tables or (),
             )
-            potential_drepcation_tables.append(
-                {"name": db_table, "last_altered": table["LAST_ALTERED"]}
+        if not potential_drepcation_tables:
+            print("No potential tables found.")
+            return
+
+        lookback_days = max(unread_days or 0, USAGE_LOOKBACK_DAYS)
+        with session.cursor(DictCursor) as cursor:
+            usage = cache.cached_query(
+                cursor,
+                _usage_query(
+                    databases=selected_databases,
+                    schemas=selected_schemas,
+                    lookback_days=lookback_days,
+                ),
+                scope=_scope(selected_databases),
             )
+        potential_drepcation_tables = _rank_candidate_tables(
+            candidates=potential_drepcation_tables,
+            usage=usage,
+            now=datetime.datetime.now(datetime.timezone.utc),
+            min_bytes=min_bytes,
+            unread_days=unread_days,
+        )
         if not potential_drepcation_tables:
             print("No potential tables found.")
             return
-        potential_drepcation_tables.sort(key=lambda x: x["name"])
 
         max_table_name_length: int = max(
             len(table["name"]) for table in potential_drepcation_tables
@@ -251,12 +409,13 @@ def mark_objects_for_removal(
         potential_drepcation_tables_choices = [
             Choice(
                 title=f"{table['name']}".ljust(max_table_name_length + 8)
-                + f"Last altered: {table['last_altered']}",
+                + _format_bytes(table["reclaimable_bytes"]).rjust(10)
+                + f"    Last read: {table['last_read'] or f'not in {lookback_days} days'}"
+                + f"    Last altered: {table['last_altered']}",
                 value=table,
             )
             for table in potential_drepcation_tables
         ]
-        potential_drepcation_tables_choices.sort(key=lambda x: x.title)
 
     if dry_run:
         print("Potential tables to mark for removal:")
@@ -313,23 +472,29 @@ def mark_objects_for_removal(
             removal_month=removal_year_month,
             user_alias=config.get("user_alias", "unknown"),
         )
-        with _snow_connection() as cursor:
+        with session.cursor(DictCursor) as cursor:
             for query in dispose_queries:
                 cursor.execute(query)
-
-
-def _get_marked_objects():
-    with _snow_connection() as cursor:
-        q = f"show databases like '%drp%' in account"
-        cursor.execute(q)
-        databases = cursor.fetchall()
-        cursor.execute(f"show schemas like '%drp%' in account")
-        schemas = cursor.fetchall()
-        cursor.execute(f"show tables like '%drp%' in account")
-        tables = cursor.fetchall()
-        cursor.execute(f"show views like '%drp%' in account")
-        views = cursor.fetchall()
-    return databases, schemas, tables, views
+        cache.invalidate(*(table["name"] for table in selected_tables))
+
+
+def _get_marked_objects(use_cache: bool = True):
+    """Databases, schemas, tables and views marked for removal in the account.
+
+    Without use_cache they are always queried, as objects may have been
+    marked, unmarked or dropped by others since they were cached.
+    """
+    queries = [
+        f"show {object_type} like '%drp%' in account"
+        for object_type in ["databases", "schemas", "tables", "views"]
+    ]
+    with session.cursor(DictCursor) as cursor:
+        if use_cache:
+            return tuple(
+                cache.cached_query(cursor, query, scope=cache.ACCOUNT_SCOPE)
+                for query in queries
+            )
+        return tuple(cursor.execute(query).fetchall() for query in queries)
 
 
 def _is_potential_drp_object(object_name: str, compare_date: datetime.date) -> bool:
@@ -415,7 +580,8 @@ def _drop_object_query_builder(
 
 def remove_marked_objects(dry_run: bool):
     compare_date = datetime.date.today()
-    databases, schemas, tables, views = _get_marked_objects()
+    # The drop statements are built from what is marked right now
+    databases, schemas, tables, views = _get_marked_objects(use_cache=dry_run)
     (
         potential_drp_databases,
         potential_drp_schemas,
@@ -562,9 +728,10 @@ def remove_marked_objects(dry_run: bool):
         tables=remove_tables,
         views=remove_views,
     )
-    with _snow_connection() as cursor:
+    with session.cursor(DictCursor) as cursor:
         for query in drop_queries:
             cursor.execute(query)
+    cache.invalidate(*remove_databases, *remove_schemas, *remove_tables, *remove_views)
     print("Objects removed.")
     print("Done.")
     return